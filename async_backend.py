@@ -0,0 +1,175 @@
+# async_backend.py
+# asyncio transport for the Quartzy and eLabFTW APIs, used with --async
+# only covers the operations needed by the sync, with the same retry policy as the generated eLabFTW client
+# requires the optional aiohttp dependency: uv sync --extra async
+
+import asyncio
+import json
+import logging
+import ssl
+import time
+
+import aiohttp
+
+from utils import QuartzyFetchError, TokenBucket, quartzy_page_items, quartzy_page_requests, parse_retry_after, retry_backoff
+from utils import RETRY_TOTAL, RETRY_STATUSES, RETRY_METHODS
+
+class AsyncApiError(Exception):
+    def __init__(self, method, url, status, body):
+        super().__init__(f"{method} {url} failed with status {status}: {body[:200]}")
+        self.status = status
+
+class AsyncTransport:
+    # concurrency is the maximum number of eLabFTW requests in flight, Quartzy pages are limited by fetch_concurrency
+    # verify is False (--insecure), True, or the path of a CA bundle
+    # must be created from a running event loop
+    def __init__(self, elabftw_host_url, elabftw_api_key, quartzy_headers, concurrency=8, fetch_concurrency=4, verify=True, profiler=None):
+        self.elabftw_host_url = elabftw_host_url.rstrip("/")
+        self.quartzy_headers = quartzy_headers
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.fetch_concurrency = fetch_concurrency
+        self.profiler = profiler
+        if verify is True:
+            ssl_context = True
+        elif verify:
+            ssl_context = ssl.create_default_context(cafile=verify)
+        else:
+            ssl_context = False
+        # proxies (HTTP_PROXY, HTTPS_PROXY, NO_PROXY) are read from the environment (trust_env)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=concurrency + fetch_concurrency, ssl=ssl_context),
+            timeout=aiohttp.ClientTimeout(total=60),
+            trust_env=True,
+        )
+        self.elabftw_headers = {
+            "Authorization": elabftw_api_key,
+            "Accept": "application/json",
+            # filter eLabFTW traffic in mitmproxy
+            "X-Proxy-Trace": "quartzy2elabftw",
+        }
+
+    async def aclose(self):
+        await self.session.close()
+
+    # the body is read before returning, which releases the connection
+    # retry is True when the request is sent again after a transient error, for the metrics
+    async def send(self, method, url, retry=False, **kwargs):
+        start = time.perf_counter()
+        status = None
+        body = b""
+        try:
+            response = await self.session.request(method, url, **kwargs)
+            body = await response.read()
+            status = response.status
+            return response
+        finally:
+            if self.profiler:
+                bytes_sent = len(json.dumps(kwargs["json"]).encode("utf-8")) if "json" in kwargs else 0
+                self.profiler.add_request(method, url, time.perf_counter() - start, status, int(retry), bytes_sent, len(body))
+
+    # eLabFTW request with retries on transient errors, raises AsyncApiError on error statuses
+    async def elabftw_request(self, method, path, **kwargs):
+        url = f"{self.elabftw_host_url}{path}"
+        async with self.semaphore:
+            for retry_number in range(RETRY_TOTAL + 1):
+                retryable = method in RETRY_METHODS and retry_number < RETRY_TOTAL
+                if retry_number:
+                    await asyncio.sleep(retry_backoff(retry_number))
+                try:
+                    response = await self.send(method, url, retry=retry_number > 0, headers=self.elabftw_headers, **kwargs)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if retryable:
+                        logging.warning(f"{method} {url} failed ({e}), retrying")
+                        continue
+                    raise
+                if response.status in RETRY_STATUSES and retryable:
+                    # honor Retry-After on 503, like urllib3
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    if retry_after:
+                        await asyncio.sleep(retry_after)
+                    continue
+                if response.status >= 400:
+                    raise AsyncApiError(method, url, response.status, await response.text())
+                return response
+
+    #########################
+    #        QUARTZY        #
+    #########################
+
+    # same as utils.iter_quartzy_pages: pages are requested ahead and yielded in order until the first empty one,
+    # and with a state.PageCache the pages whose content was already synced are yielded as None
+    async def iter_quartzy_pages(self, api_url, per_page=25, start_page=1, cache=None):
+        bucket = TokenBucket()
+        pending = []
+        next_page = start_page
+
+        # sends the requests of quartzy_page_requests
+        async def fetch(page):
+            page_requests = quartzy_page_requests(page, self.quartzy_headers, bucket, cache)
+            answer = None
+            while True:
+                try:
+                    request = page_requests.send(answer)
+                except StopIteration as stop:
+                    return stop.value
+                if isinstance(request, dict):
+                    response = await self.send("GET", api_url, headers=request, params={"page": page, "per_page": per_page})
+                    answer = (response.status, response.headers, await response.read())
+                else:
+                    await asyncio.sleep(request)
+                    answer = None
+
+        def submit():
+            nonlocal next_page
+            pending.append((next_page, asyncio.create_task(fetch(next_page))))
+            next_page += 1
+
+        for _ in range(self.fetch_concurrency):
+            submit()
+        try:
+            while pending:
+                page, task = pending.pop(0)
+                try:
+                    page_items = quartzy_page_items(page, *await task)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logging.error(f"Failed to fetch page {page}: {e}")
+                    raise QuartzyFetchError(f"Failed to fetch page {page}: {e}") from e
+                if page_items is not None and not page_items:
+                    break
+                submit()
+                yield page_items
+        finally:
+            # pages requested past the end are not needed anymore
+            for _, task in pending:
+                task.cancel()
+
+    #########################
+    #        eLabFTW        #
+    #########################
+
+    @staticmethod
+    def location_id(response):
+        return int(response.headers.get("Location", "").rstrip("/").split("/")[-1])
+
+    async def read_team_resources_categories(self, team):
+        response = await self.elabftw_request("GET", f"/teams/{team}/resources_categories")
+        return json.loads(await response.read())
+
+    async def post_team_one_rescat(self, team, body):
+        response = await self.elabftw_request("POST", f"/teams/{team}/resources_categories", json=body)
+        return self.location_id(response)
+
+    async def read_items(self, **params):
+        response = await self.elabftw_request("GET", "/items", params=params)
+        return json.loads(await response.read())
+
+    async def post_item(self, body):
+        response = await self.elabftw_request("POST", "/items", json=body)
+        return self.location_id(response)
+
+    async def patch_item(self, item_id, body):
+        response = await self.elabftw_request("PATCH", f"/items/{item_id}", json=body)
+        return json.loads(await response.read())
+
+    async def post_tag(self, item_id, body):
+        await self.elabftw_request("POST", f"/items/{item_id}/tags", json=body)
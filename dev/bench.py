@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# © Deltablot 2025
+# License: MIT
+
+# dev file: offline benchmark of main.py against the mock Quartzy and eLabFTW servers
+# for each inventory size, three runs are measured on the same servers and state dir:
+#   initial: empty eLabFTW, every item is created
+#   resync: nothing changed since the previous run
+#   update: 10% of the items changed in Quartzy
+# usage:
+#   python dev/bench.py --sizes 1000 10000 --output bench.json
+#   python dev/bench.py --sizes 1000 10000 --baseline bench.json  # exit 1 if slower than the baseline
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_servers import MockState, make_quartzy_items, start_mock_server
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PEAK_RSS = os.path.join(ROOT_DIR, "dev", "peak_rss.py")
+CATEGORIES = ["Antibody", "Plasmid", "-80 boxes"]
+
+parser = argparse.ArgumentParser(description="Benchmark main.py against mock Quartzy and eLabFTW servers")
+parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000], help="Inventory sizes, e.g. 1000 10000 100000")
+parser.add_argument("--latency", type=float, default=0.0, help="Artificial latency per request, in seconds")
+parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 429/503")
+parser.add_argument("--main-args", default="--workers 4", help="Arguments passed to main.py (default: --workers 4)")
+parser.add_argument("--output", help="Write the results to this JSON file")
+parser.add_argument("--baseline", help="Compare with the results of a previous --output and fail on regressions")
+parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed slowdown/memory growth over the baseline (default: 0.1 = 10%%)")
+args = parser.parse_args()
+
+def run_main(env):
+    # the peak memory is measured by peak_rss.py: ru_maxrss would include the memory of this process and its mock servers
+    peak_rss_path = os.path.join(env["STATE_DIR"], "peak_rss.txt")
+    start = time.perf_counter()
+    returncode = subprocess.call(
+        [sys.executable, PEAK_RSS, peak_rss_path, "main.py", *args.main_args.split()],
+        cwd=ROOT_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    elapsed = time.perf_counter() - start
+    if returncode != 0:
+        sys.exit(f"main.py exited with {returncode}")
+    with open(peak_rss_path) as f:
+        return elapsed, float(f.read())
+
+def bench_size(size):
+    quartzy_items = make_quartzy_items(size, CATEGORIES)
+    state = MockState(quartzy_items, latency=args.latency, error_rate=args.error_rate)
+    server = start_mock_server(state)
+    port = server.server_address[1]
+    results = {}
+    with tempfile.TemporaryDirectory() as state_dir:
+        env = dict(
+            os.environ,
+            QUARTZY_TOKEN="mock",
+            QUARTZY_API_INVENTORY_URL=f"http://127.0.0.1:{port}/inventory-items",
+            ELABFTW_HOST_URL=f"http://127.0.0.1:{port}/api/v2",
+            ELABFTW_API_KEY="mock",
+            CATEGORIES=json.dumps(CATEGORIES),
+            STATE_DIR=state_dir,
+        )
+        for scenario in ("initial", "resync", "update"):
+            if scenario == "update":
+                for item in quartzy_items[::10]:
+                    item["quantity"] = str(int(item["quantity"]) + 1)
+                    item["updated_at"] = "2026-01-01T00:00:00Z"
+            with state.lock:
+                state.requests.clear()
+            elapsed, peak_rss = run_main(env)
+            with state.lock:
+                requests = dict(state.requests)
+            results[scenario] = {
+                "seconds": round(elapsed, 3),
+                "peak_rss_mb": round(peak_rss, 1),
+                "requests": sum(requests.values()),
+                "requests_by_endpoint": requests,
+                "elabftw_items": len(state.items),
+            }
+            print(
+                f"size={size:<7} {scenario:<8} time={elapsed:8.2f}s peak_rss={peak_rss:7.1f}MB "
+                f"requests={sum(requests.values()):<7} items={len(state.items)}"
+            )
+    server.shutdown()
+    server.server_close()
+    return results
+
+results = {
+    "settings": {"latency": args.latency, "error_rate": args.error_rate, "main_args": args.main_args},
+    "sizes": {str(size): bench_size(size) for size in args.sizes},
+}
+
+if args.output:
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+if args.baseline:
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("settings") != results["settings"]:
+        print(f"Warning: baseline settings differ: {baseline.get('settings')}")
+    regressions = []
+    for size, scenarios in results["sizes"].items():
+        for scenario, result in scenarios.items():
+            previous = baseline.get("sizes", {}).get(size, {}).get(scenario)
+            if not previous:
+                continue
+            for metric in ("seconds", "peak_rss_mb", "requests"):
+                if result[metric] > previous[metric] * (1 + args.tolerance):
+                    regressions.append(f"size={size} {scenario} {metric}: {previous[metric]} -> {result[metric]}")
+    if regressions:
+        print("Regressions over the baseline:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print("No regression over the baseline.")
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# © Deltablot 2025
+# License: MIT
+
+# dev file: check that existing eLabFTW items are loaded page by page and only for the synced categories
+# the mock eLabFTW serves 50k synced items with the extra fields of a sync plus unrelated ones with large bodies,
+# Quartzy serves nothing so no write happens
+# usage: python dev/bench_load_items.py --items 50000
+#        python dev/bench_load_items.py --items 100000 --max-rss 256  # exit 1 above 256 MB, e.g. to check a container limit
+import argparse
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_servers import MockState, make_quartzy_items, start_mock_server
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from fields import DEFAULT_FIELD_MAPPING, compile_field_mapping  # noqa: E402
+
+CATEGORIES = ["Antibody", "Plasmid", "-80 boxes"]
+
+parser = argparse.ArgumentParser(description="Benchmark the loading of existing eLabFTW items")
+parser.add_argument("--items", type=int, default=50000, help="Number of synced items in eLabFTW")
+parser.add_argument("--unrelated", type=int, default=10000, help="Number of items in categories that are not synced")
+parser.add_argument("--max-rss", type=float, help="Fail when the peak memory of main.py is above this many MB")
+args = parser.parse_args()
+
+# the extra fields of a synced item, only the Quartzy ID changes between items
+extra_fields = compile_field_mapping(DEFAULT_FIELD_MAPPING)(make_quartzy_items(1, CATEGORIES)[0])
+
+state = MockState([])
+for category in CATEGORIES + ["Equipment"]:
+    state.categories[category] = len(state.categories) + 1
+for i in range(args.items + args.unrelated):
+    synced = i < args.items
+    state.items[state.next_id] = {
+        "id": state.next_id,
+        "title": f"Item {i}",
+        "body": "" if synced else "<p>" + "x" * 2000 + "</p>",
+        "category": (i % len(CATEGORIES)) + 1 if synced else len(CATEGORIES) + 1,
+        "metadata": json.dumps({"extra_fields": {**extra_fields, "Quartzy ID": {"type": "text", "value": f"q-{i:07d}"}}}),
+        "locked": 1,
+        "state": 1,
+    }
+    state.next_id += 1
+
+server = start_mock_server(state)
+port = server.server_address[1]
+
+with tempfile.TemporaryDirectory() as state_dir:
+    env = dict(
+        os.environ,
+        QUARTZY_TOKEN="mock",
+        QUARTZY_API_INVENTORY_URL=f"http://127.0.0.1:{port}/inventory-items",
+        ELABFTW_HOST_URL=f"http://127.0.0.1:{port}/api/v2",
+        ELABFTW_API_KEY="mock",
+        CATEGORIES=json.dumps(CATEGORIES),
+        STATE_DIR=state_dir,
+    )
+    # the peak memory is measured by peak_rss.py: ru_maxrss would include the memory of this process and its mock server
+    peak_rss_path = os.path.join(state_dir, "peak_rss.txt")
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "dev/peak_rss.py", peak_rss_path, "main.py", "--rebuild-index"], cwd=ROOT_DIR, env=env, check=True)
+    elapsed = time.perf_counter() - start
+    with open(peak_rss_path) as f:
+        peak_rss = float(f.read())
+    with sqlite3.connect(os.path.join(state_dir, "index.sqlite")) as conn:
+        indexed = conn.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+server.shutdown()
+
+print(f"indexed={indexed} requests={state.requests} time={elapsed:.2f}s peak_rss={peak_rss:.1f}MB")
+if indexed != args.items:
+    sys.exit(f"Expected {args.items} indexed items, got {indexed}")
+if args.max_rss and peak_rss > args.max_rss:
+    sys.exit(f"Peak memory {peak_rss:.1f}MB is above {args.max_rss}MB")
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# © Deltablot 2025
+# License: MIT
+
+# dev file: micro-benchmark of the extra fields builder, without any server
+# compares the compiled field mapping of fields.py with the previous hand-written build_metadata, and checks they give the same output
+# usage: python dev/bench_metadata.py --items 100000
+import argparse
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+from mock_servers import make_quartzy_items
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from fields import DEFAULT_FIELD_MAPPING, compile_field_mapping  # noqa: E402
+from utils import compute_reminder_date  # noqa: E402
+
+parser = argparse.ArgumentParser(description="Benchmark the extra fields builder")
+parser.add_argument("--items", type=int, default=100000, help="Number of Quartzy items")
+parser.add_argument("--repeat", type=int, default=3, help="Runs of each builder, the best one is reported")
+args = parser.parse_args()
+
+# build_metadata before the field mapping, with the reminder date computed on every call
+def reference_extra_fields(item, reminder_date=compute_reminder_date.__wrapped__):
+    extra_fields = {
+        "Quartzy ID": {"type": "text", "value": item.get("id")},
+        "Name": {"type": "text", "value": item.get("name", "")},
+        "Vendor": {"type": "text", "value": item.get("vendor", "")},
+        "Catalog Number": {"type": "text", "value": item.get("catalog_number", "")},
+        "Quantity": {
+            "type": "number",
+            "units": [item.get("unit_size", "")],
+            "unit": item.get("unit_size", ""),
+            "value": item.get("quantity", "")
+        },
+        "Price": {"type": "number", "units": ["€", "$"], "unit": "€", "value": item.get("price", "")},
+        "Open in Quartzy": {"type": "url", "value": item.get("app_url", "")},
+        "Public URL": {"type": "url", "description": "Origin URL of the item", "value": item.get("url", "")},
+        "Owner": {
+            "type": "text",
+            "value": f'{(item.get("added_by") or {}).get("first_name", "")} {(item.get("added_by") or {}).get("last_name", "")}'.strip()
+        },
+        "Owner Contact": {"type": "email", "value": (item.get("added_by") or {}).get("email", "")},
+        "Cas Number": {"type": "text", "value": item.get("cas_number", "")},
+        "Lot Number": {"type": "text", "value": item.get("lot_number", "")},
+        "Serial Number": {"type": "text", "value": item.get("serial_number", "")},
+        "Location": {"type": "text", "value": (item.get("location") or {}).get("name", "")},
+        "Sub-location": {"type": "text", "value": (item.get("sublocation") or {}).get("name", "")},
+        "Technical details": {"type": "text", "value": item.get("technical_details", "")},
+        "Expiration Date": {"type": "text", "value": item.get("expiration_date", "")},
+        "Reminder Date": {
+            "type": "date",
+            "value": reminder_date(item.get("expiration_date", ""), item.get("auto_reminder", ""))
+        }
+    }
+    return {k: v for k, v in extra_fields.items() if v.get("value")}
+
+def best_time(build, items):
+    best = None
+    for _ in range(args.repeat):
+        compute_reminder_date.cache_clear()
+        start = time.perf_counter()
+        for item in items:
+            build(item)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+items = make_quartzy_items(args.items, ["Antibody", "Plasmid", "-80 boxes"])
+# expiration dates spread over two years and a few missing fields, closer to a real inventory
+for i, item in enumerate(items):
+    item["expiration_date"] = (date(2030, 1, 1) + timedelta(days=i % 730)).isoformat()
+    item["auto_reminder"] = ("1WEEK", "2WEEK", "1MONTH", "NONE")[i % 4]
+    if i % 7 == 0:
+        item["added_by"] = None
+    if i % 11 == 0:
+        del item["location"]
+
+compiled = compile_field_mapping(DEFAULT_FIELD_MAPPING)
+mismatches = sum(1 for item in items if compiled(item) != reference_extra_fields(item))
+if mismatches:
+    sys.exit(f"{mismatches} items differ from the reference builder")
+
+reference = best_time(reference_extra_fields, items)
+fast = best_time(compiled, items)
+print(f"items={args.items} reference={reference:.2f}s ({reference / args.items * 1e6:.1f}µs/item)")
+print(f"items={args.items} compiled={fast:.2f}s ({fast / args.items * 1e6:.1f}µs/item) speedup={reference / fast:.1f}x")
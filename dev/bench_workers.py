@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# © Deltablot 2025
+# License: MIT
+
+# dev file: compare the sync duration for several --workers values against a mock eLabFTW server with artificial latency
+# usage: python dev/bench_workers.py --items 300 --latency 0.05 --workers 1 4 8
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_servers import MockState, make_quartzy_items, start_mock_server
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CATEGORIES = ["Antibody", "Plasmid", "-80 boxes"]
+
+parser = argparse.ArgumentParser(description="Benchmark main.py --workers against a mock eLabFTW server")
+parser.add_argument("--items", type=int, default=300)
+parser.add_argument("--latency", type=float, default=0.05, help="Artificial latency per request, in seconds")
+parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+args = parser.parse_args()
+
+for workers in args.workers:
+    # fresh server for every run so each one creates all the items
+    state = MockState(make_quartzy_items(args.items, CATEGORIES), latency=args.latency)
+    server = start_mock_server(state)
+    port = server.server_address[1]
+    # and a fresh local index, so nothing is left from the previous run or from a real sync
+    with tempfile.TemporaryDirectory() as state_dir:
+        env = dict(
+            os.environ,
+            QUARTZY_TOKEN="mock",
+            QUARTZY_API_INVENTORY_URL=f"http://127.0.0.1:{port}/inventory-items",
+            ELABFTW_HOST_URL=f"http://127.0.0.1:{port}/api/v2",
+            ELABFTW_API_KEY="mock",
+            CATEGORIES=json.dumps(CATEGORIES),
+            STATE_DIR=state_dir,
+        )
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "main.py", "--workers", str(workers)], cwd=ROOT_DIR, env=env, check=True)
+        elapsed = time.perf_counter() - start
+    server.shutdown()
+    print(f"workers={workers:<3} items={len(state.items):<6} requests={sum(state.requests.values()):<6} time={elapsed:.2f}s")
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# © Deltablot 2025
+# License: MIT
+
+# dev file: local stand-ins for the Quartzy and eLabFTW APIs, used to benchmark the sync without hitting real servers
+# run standalone with: python dev/mock_servers.py --items 1000 --latency 0.05 --error-rate 0.01
+import argparse
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+def make_quartzy_items(count, categories):
+    # synthetic inventory with the same shape as the Quartzy API output
+    items = []
+    for i in range(count):
+        items.append({
+            "id": f"q-{i:07d}",
+            "name": f"Item {i}",
+            "vendor": "ACME",
+            "catalog_number": f"CAT-{i}",
+            "unit_size": "ml",
+            "quantity": str(i % 50),
+            "price": f"{i % 100}.00",
+            "app_url": f"https://app.quartzy.com/items/{i}",
+            "url": "",
+            "added_by": {"first_name": "Jane", "last_name": "Doe", "email": "jane@example.org"},
+            "cas_number": "",
+            "lot_number": f"L{i}",
+            "serial_number": "",
+            "location": {"name": "Fridge"},
+            "sublocation": {"name": "Shelf 2"},
+            "technical_details": "Store at -20°C\nKeep away from light",
+            "expiration_date": "2030-06-28",
+            "auto_reminder": "2WEEK",
+            "type": {"name": categories[i % len(categories)]},
+            "updated_at": "2025-01-01T00:00:00Z",
+        })
+    return items
+
+
+class MockState:
+    # everything the mock servers share, guarded by a lock as requests are served from several threads
+    # error_rate is the fraction of requests answered with 429 (Quartzy) or 503 (eLabFTW) before doing anything
+    # with etags, Quartzy pages have an ETag and If-None-Match is answered with 304 when they didn't change
+    def __init__(self, quartzy_items, latency=0.0, error_rate=0.0, etags=False):
+        self.lock = threading.Lock()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.etags = etags
+        self.quartzy_items = quartzy_items
+        self.categories = {}
+        self.items = {}
+        self.next_id = 1
+        self.requests = {}
+
+    def count(self, method, endpoint):
+        with self.lock:
+            key = f"{method} {endpoint}"
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, avoid the delayed ACK stall on keep-alive connections
+    disable_nagle_algorithm = True
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload=None, headers=None):
+        data = json.dumps(payload).encode() if payload is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        body = self.read_json() if method in ("POST", "PATCH") else {}
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        for pattern, route_method, handler in self.routes:
+            match = re.fullmatch(pattern, url.path)
+            if match and route_method == method:
+                if self.state.error_rate and random.random() < self.state.error_rate:
+                    self.state.count(method, f"{pattern} (error)")
+                    if pattern == "/inventory-items":
+                        return self.send_json(429, {"message": "Too Many Requests"}, headers={"Retry-After": "1"})
+                    return self.send_json(503, {"code": 503, "description": "Service Unavailable"})
+                self.state.count(method, pattern)
+                return handler(self, query, body, *match.groups())
+        self.send_json(404, {"code": 404, "description": f"No route for {method} {url.path}"})
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+
+    #########################
+    #        QUARTZY        #
+    #########################
+
+    def quartzy_inventory(self, query, body):
+        page = int(query.get("page", 1))
+        per_page = int(query.get("per_page", 25))
+        start = (page - 1) * per_page
+        page_items = self.state.quartzy_items[start:start + per_page]
+        if not self.state.etags:
+            return self.send_json(200, page_items)
+        etag = '"' + hashlib.sha1(json.dumps(page_items).encode()).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.state.count("GET", "/inventory-items (304)")
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_json(200, page_items, headers={"ETag": etag})
+
+    #########################
+    #        eLabFTW        #
+    #########################
+
+    def read_categories(self, query, body, team):
+        with self.state.lock:
+            payload = [{"id": cid, "title": title, "color": "000000"} for title, cid in self.state.categories.items()]
+        self.send_json(200, payload)
+
+    def post_category(self, query, body, team):
+        with self.state.lock:
+            new_id = len(self.state.categories) + 1
+            self.state.categories[body["name"]] = new_id
+        self.send_json(201, headers={"Location": f"/api/v2/teams/{team}/resources_categories/{new_id}"})
+
+    def read_info(self, query, body):
+        self.send_json(200, {"elabftw_version": "5.3.0", "elabftw_version_int": 50300, "items_count": len(self.state.items)})
+
+    def read_items(self, query, body):
+        with self.state.lock:
+            items = list(self.state.items.values())
+        if query.get("cat"):
+            categories = {int(cat) for cat in query["cat"].split(",")}
+            items = [item for item in items if item["category"] in categories]
+        # deleted items are never listed, archived ones only when asked for
+        states = {int(state) for state in query.get("state", "1,2").split(",")} - {3}
+        items = [item for item in items if item["state"] in states]
+        if query.get("order") == "id":
+            items.sort(key=lambda item: item["id"], reverse=query.get("sort") == "desc")
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("limit", 15))
+        self.send_json(200, items[offset:offset + limit])
+
+    def post_item(self, query, body):
+        with self.state.lock:
+            new_id = self.state.next_id
+            self.state.next_id += 1
+            self.state.items[new_id] = {
+                "id": new_id,
+                "title": body.get("title", "Untitled"),
+                "body": body.get("body", ""),
+                "category": body.get("category"),
+                "metadata": body.get("metadata"),
+                "locked": 0,
+                "state": 1,
+            }
+        self.send_json(201, headers={"Location": f"/api/v2/items/{new_id}"})
+
+    def patch_item(self, query, body, item_id):
+        with self.state.lock:
+            item = self.state.items.get(int(item_id))
+            if item is None:
+                return self.send_json(404, {"code": 404, "description": "Nothing to show with this id"})
+            action = body.pop("action", None)
+            if action in ("lock", "forcelock"):
+                item["locked"] = 1
+            elif action == "archive":
+                item["state"] = 2
+            item.update(body)
+            payload = dict(item)
+        self.send_json(200, payload)
+
+    def post_tag(self, query, body, item_id):
+        with self.state.lock:
+            item = self.state.items.get(int(item_id))
+            if item is None:
+                return self.send_json(404, {"code": 404, "description": "Nothing to show with this id"})
+            # listed as a single string, like read_items does
+            item["tags"] = "|".join(filter(None, [item.get("tags"), body["tag"]]))
+        self.send_json(201)
+
+    routes = [
+        (r"/inventory-items", "GET", quartzy_inventory),
+        (r"/api/v2/teams/(\w+)/resources_categories", "GET", read_categories),
+        (r"/api/v2/teams/(\w+)/resources_categories", "POST", post_category),
+        (r"/api/v2/info", "GET", read_info),
+        (r"/api/v2/items", "GET", read_items),
+        (r"/api/v2/items", "POST", post_item),
+        (r"/api/v2/items/(\d+)", "PATCH", patch_item),
+        (r"/api/v2/items/(\d+)/tags", "POST", post_tag),
+    ]
+
+
+class MockServer(ThreadingHTTPServer):
+    # the default listen backlog of 5 makes concurrent clients wait for SYN retransmits
+    request_queue_size = 128
+
+    # clients killed in the middle of a request are expected, e.g. when testing resumed syncs
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+def start_mock_server(state, port=0):
+    # serve both APIs from the same port: Quartzy on /inventory-items, eLabFTW on /api/v2
+    handler = type("BoundMockHandler", (MockHandler,), {"state": state})
+    server = MockServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run mock Quartzy and eLabFTW servers")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--items", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.0, help="Artificial latency per request, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with an error")
+    parser.add_argument("--categories", default='["Antibody", "Plasmid", "-80 boxes"]')
+    parser.add_argument("--etags", action="store_true", help="Send ETags on Quartzy pages and answer conditional requests")
+    args = parser.parse_args()
+
+    state = MockState(make_quartzy_items(args.items, json.loads(args.categories)), latency=args.latency, error_rate=args.error_rate, etags=args.etags)
+    server = start_mock_server(state, args.port)
+    print(f"QUARTZY_API_INVENTORY_URL=http://127.0.0.1:{args.port}/inventory-items")
+    print(f"ELABFTW_HOST_URL=http://127.0.0.1:{args.port}/api/v2")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# © Deltablot 2025
+# License: MIT
+
+# dev file: runs a python script and writes its peak memory in MB to a file when it exits
+# the ru_maxrss of a child process also counts the memory of its parent at fork time (the mock servers and their items),
+# the VmHWM of /proc/self/status only covers this process once started
+# usage: python dev/peak_rss.py peak.txt main.py --workers 4
+import atexit
+import os
+import runpy
+import sys
+
+output, script = sys.argv[1], sys.argv[2]
+
+def write_peak_rss():
+    with open("/proc/self/status") as f:
+        peak = next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+    # VmHWM is in kilobytes
+    with open(output, "w") as f:
+        f.write(f"{peak / 1024:.1f}\n")
+
+atexit.register(write_peak_rss)
+sys.argv = sys.argv[2:]
+sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+runpy.run_path(script, run_name="__main__")
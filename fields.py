@@ -0,0 +1,126 @@
+# fields.py
+# mapping of the Quartzy item fields to the eLabFTW extra fields, compiled once into a builder called for every item
+
+from utils import compute_reminder_date
+
+# extra field name -> spec, in the order the fields are shown in eLabFTW
+# source is the Quartzy field holding the value, with dots for nested objects (e.g. "location.name"),
+# or a list of fields whose values are joined with a space
+# unit_source fills unit and units from a Quartzy field, compute names a function of COMPUTED_FIELDS called with the source values
+# the other keys (type, units, unit, description...) are copied as is, fields without a value are left out
+DEFAULT_FIELD_MAPPING = {
+    # keep unique identifier from quartzy to patch existing in eLabFTW
+    "Quartzy ID": {"type": "text", "source": "id"},
+    "Name": {"type": "text", "source": "name"},
+    "Vendor": {"type": "text", "source": "vendor"},
+    "Catalog Number": {"type": "text", "source": "catalog_number"},
+    # the quantity unit is not available via Quartzy API, neither are MIN/MAX to stock
+    "Quantity": {"type": "number", "unit_source": "unit_size", "source": "quantity"},
+    # the price unit is not available via Quartzy API
+    "Price": {"type": "number", "units": ["€", "$"], "unit": "€", "source": "price"},
+    "Open in Quartzy": {"type": "url", "source": "app_url"},
+    "Public URL": {"type": "url", "description": "Origin URL of the item", "source": "url"},
+    "Owner": {"type": "text", "source": ["added_by.first_name", "added_by.last_name"]},
+    "Owner Contact": {"type": "email", "source": "added_by.email"},
+    "Cas Number": {"type": "text", "source": "cas_number"},
+    "Lot Number": {"type": "text", "source": "lot_number"},
+    "Serial Number": {"type": "text", "source": "serial_number"},
+    "Location": {"type": "text", "source": "location.name"},
+    "Sub-location": {"type": "text", "source": "sublocation.name"},
+    "Technical details": {"type": "text", "source": "technical_details"},
+    "Expiration Date": {"type": "text", "source": "expiration_date"},
+    "Reminder Date": {"type": "date", "compute": "reminder_date", "source": ["expiration_date", "auto_reminder"]},
+}
+
+# the eLabFTW items are matched to Quartzy with this field, so it can't be changed
+ID_FIELD = "Quartzy ID"
+
+COMPUTED_FIELDS = {
+    # convert auto_reminder date from string to date (e.g. "1WEEK" -> date - 1 week)
+    "reminder_date": compute_reminder_date,
+}
+
+# default mapping with the fields of overrides added or replaced, a null spec removes a field
+def load_field_mapping(overrides):
+    if not isinstance(overrides, dict):
+        raise ValueError("expected an object of field name -> spec")
+    if ID_FIELD in overrides:
+        raise ValueError(f"the '{ID_FIELD}' field can't be changed")
+    mapping = dict(DEFAULT_FIELD_MAPPING)
+    for name, spec in overrides.items():
+        if spec is None:
+            mapping.pop(name, None)
+        else:
+            mapping[name] = spec
+    return mapping
+
+# function returning the value at path in a Quartzy item, "" when missing
+def compile_getter(path):
+    keys = path.split(".")
+    last = keys[-1]
+    if len(keys) == 1:
+        return lambda item: item.get(last, "")
+    if len(keys) == 2:
+        first = keys[0]
+        return lambda item: (item.get(first) or {}).get(last, "")
+    parents = keys[:-1]
+
+    def get(item):
+        for key in parents:
+            item = item.get(key) or {}
+        return item.get(last, "")
+    return get
+
+# function returning the extra field built from a Quartzy item, or None when it has no value
+def compile_field(name, spec):
+    if not isinstance(spec, dict):
+        raise ValueError(f"the spec of '{name}' must be an object")
+    static = dict(spec)
+    source = static.pop("source", None)
+    unit_source = static.pop("unit_source", None)
+    compute = static.pop("compute", None)
+    if not source:
+        raise ValueError(f"the field '{name}' has no source")
+    getters = tuple(compile_getter(path) for path in ([source] if isinstance(source, str) else source))
+
+    if compute:
+        function = COMPUTED_FIELDS.get(compute)
+        if function is None:
+            raise ValueError(f"unknown compute '{compute}' for '{name}', expected one of {', '.join(COMPUTED_FIELDS)}")
+        get_value = lambda item: function(*(get(item) for get in getters))
+    elif len(getters) == 1:
+        get_value = getters[0]
+    else:
+        get_value = lambda item: " ".join(f"{get(item)}" for get in getters).strip()
+
+    get_unit = compile_getter(unit_source) if unit_source else None
+    # lists are copied for every item, the other static values are immutable
+    list_keys = tuple(key for key, value in static.items() if isinstance(value, list))
+
+    def build(item):
+        value = get_value(item)
+        if not value:
+            return None
+        field = static.copy()
+        for key in list_keys:
+            field[key] = list(field[key])
+        if get_unit:
+            unit = get_unit(item)
+            field["units"] = [unit]
+            field["unit"] = unit
+        field["value"] = value
+        return field
+    return build
+
+# the returned function gives the extra fields of a Quartzy item, the mapping is validated here rather than on every item
+def compile_field_mapping(mapping):
+    fields = tuple((name, compile_field(name, spec)) for name, spec in mapping.items())
+
+    def build(item):
+        extra_fields = {}
+        for name, build_field in fields:
+            field = build_field(item)
+            if field is not None:
+                extra_fields[name] = field
+        return extra_fields
+    return build
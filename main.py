@@ -7,18 +7,30 @@
 import os
 import sys
 import elabapi_python
-import random
+import hashlib
 import html
 import json
 import logging
+import time
+import signal
+import asyncio
+import threading
+from datetime import datetime, timezone
 from tqdm import tqdm  # as we import 1000+ items, display a progress bar
 import argparse
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import urllib3
 from urllib3.util.retry import Retry
 from dotenv import load_dotenv
-# convert auto_reminder date from string to date (e.g. "1WEEK" -> date - 1 week)
-# fetch_all_quartzy_items needed as there's pagination logic not inherited from the Public API
-from utils import compute_reminder_date, fetch_all_quartzy_items
+# iter_quartzy_pages needed as there's pagination logic not inherited from the Public API
+from utils import iter_quartzy_pages, metadata_fingerprint, FINGERPRINT_VERSION, parse_timestamp, Profiler, category_color, changed_fields
+from utils import failure_reason, prometheus_text, QuartzyFetchError
+from utils import RETRY_TOTAL, RETRY_BACKOFF_FACTOR, RETRY_STATUSES, RETRY_METHODS
+# local index of the items already pushed to eLabFTW
+from state import ItemRecord, SyncIndex, PageCache, default_state_dir
+# Quartzy fields -> eLabFTW extra fields
+from fields import compile_field_mapping, load_field_mapping
 
 load_dotenv()
 
@@ -27,7 +39,8 @@ load_dotenv()
 #########################
 
 # see https://docs.quartzy.com/api/#tag/Inventory-Item
-QUARTZY_API_INVENTORY_URL = 'https://api.quartzy.com/inventory-items'
+# can be overridden to point to a local mock server (see dev/mock_servers.py)
+QUARTZY_API_INVENTORY_URL = os.getenv('QUARTZY_API_INVENTORY_URL') or 'https://api.quartzy.com/inventory-items'
 QUARTZY_TOKEN = os.getenv('QUARTZY_TOKEN') or sys.exit('QUARTZY_TOKEN environment variable not set')
 
 # Read CATEGORIES from environment variable
@@ -41,6 +54,16 @@ try:
 except json.JSONDecodeError as e:
     sys.exit(f"Failed to decode CATEGORIES environment variable: {e}")
 
+# Optional FIELD_MAPPING: extra fields added to or replacing the default ones (see fields.py), null removes a field
+# e.g. {"Storage": {"type": "text", "source": "storage_temperature"}, "Serial Number": null}
+try:
+    field_mapping = load_field_mapping(json.loads(os.getenv('FIELD_MAPPING') or '{}'))
+    build_extra_fields = compile_field_mapping(field_mapping)
+except json.JSONDecodeError as e:
+    sys.exit(f"Failed to decode FIELD_MAPPING environment variable: {e}")
+except ValueError as e:
+    sys.exit(f"Invalid FIELD_MAPPING: {e}")
+
 # Categories retrieved via API belong to the current team linked to TEAM_ID = "current"
 TEAM_ID = "current"
 
@@ -52,6 +75,16 @@ ELABFTW_HOST_URL = os.getenv('ELABFTW_HOST_URL') or sys.exit('ELABFTW_HOST_URL e
 # normalize host URL to avoid trailing slash which would produce double slashes in generated API paths (e.g. /api/v2//items)
 ELABFTW_HOST_URL = ELABFTW_HOST_URL.rstrip('/')
 ELABFTW_API_KEY = os.getenv('ELABFTW_API_KEY') or sys.exit('ELABFTW_API_KEY environment variable not set')
+# existing items are read by pages of this size
+ELABFTW_ITEMS_PAGE_SIZE = 500
+# state of the items archived in eLabFTW
+ITEM_STATE_ARCHIVED = 2
+# number of resource categories created concurrently
+CATEGORY_WORKERS = 8
+# tag added to orphan items with --orphans tag
+ORPHAN_TAG = "Removed from Quartzy"
+# set by sync_targets.py, tells the targets apart in the metrics
+SYNC_TARGET = os.getenv('SYNC_TARGET')
 
 #########################
 #     ArgumentParser    #
@@ -61,11 +94,60 @@ def parse_args():
     parser = argparse.ArgumentParser(description="Sync Quartzy Inventory to eLabFTW")
     parser.add_argument('--verbose', action='store_true', help="Enable verbose output for debugging")
     parser.add_argument('--insecure', action='store_true', help="Disable SSL verification and suppress SSL warnings")
-    return parser.parse_args()
+    parser.add_argument('--workers', type=int, default=1, help="Number of items synced concurrently with eLabFTW (default: 1)")
+    parser.add_argument('--fetch-workers', type=int, default=4, help="Number of Quartzy pages requested concurrently (default: 4)")
+    parser.add_argument('--state-dir', default=default_state_dir(), help="Directory of the local sync index (default: STATE_DIR env or ~/.local/state/quartzy2elabftw)")
+    parser.add_argument('--rebuild-index', action='store_true', help="Rebuild the local sync index from the items found in eLabFTW")
+    parser.add_argument('--rebuild-index-every', type=float, default=24, help="Hours after which the local sync index is rebuilt from eLabFTW, to find the items deleted there, 0 never does (default: 24)")
+    parser.add_argument('--page-cache-size', type=float, default=64, help="Size in MB of the cache of Quartzy pages kept in the state dir, 0 disables it (default: 64)")
+    parser.add_argument('--incremental', action='store_true', help="Only push items modified in Quartzy since the last run, with a full sync from time to time")
+    parser.add_argument('--full-sync-every', type=float, default=24, help="With --incremental, hours between two full syncs (default: 24)")
+    parser.add_argument('--profile', nargs='?', const='-', metavar='FILE', help="Print a JSON timing report at the end of the run, or write it to FILE")
+    parser.add_argument('--summary', metavar='FILE', help="Write the counts of the sync (created, updated, failed...) as JSON to FILE at the end of each run")
+    parser.add_argument('--metrics', metavar='FILE', help="At the end of each run, append its metrics (items/s, requests by endpoint and status, retries, bytes, failure reasons) to FILE as a JSON line, or write them in the Prometheus text format if FILE ends with .prom")
+    parser.add_argument('--daemon', action='store_true', help="Keep running and sync again every --interval minutes (implies --incremental)")
+    parser.add_argument('--interval', type=float, default=15, help="With --daemon, minutes between two syncs (default: 15)")
+    parser.add_argument('--orphans', choices=['archive', 'tag'], help=f"After a complete sync, archive the eLabFTW items whose Quartzy item was deleted or moved to a type that isn't synced, or tag them with '{ORPHAN_TAG}'")
+    parser.add_argument('--max-orphan-fraction', type=float, default=0.05, help="With --orphans, leave the orphans untouched when they are more than this fraction of the synced items (default: 0.05)")
+    parser.add_argument('--dedupe', nargs='?', const='report', choices=['report', 'archive'], help="Instead of syncing, list the eLabFTW items created several times for the same Quartzy ID, and with 'archive' archive all but the oldest")
+    parser.add_argument('--plan', nargs='?', const='-', metavar='FILE', help="Instead of syncing, compare Quartzy with the items in eLabFTW and write the requests a sync would send as JSON, to stdout or FILE")
+    parser.add_argument('--apply', metavar='FILE', help="Instead of syncing, send the requests of a plan written by --plan")
+    parser.add_argument('--async', dest='use_async', action='store_true', help="Send the Quartzy and eLabFTW requests from an asyncio event loop, --workers is then the number of concurrent eLabFTW requests (requires aiohttp)")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.fetch_workers < 1:
+        parser.error("--fetch-workers must be at least 1")
+    if args.page_cache_size < 0:
+        parser.error("--page-cache-size can't be negative")
+    modes = [flag for flag, enabled in (("--dedupe", args.dedupe), ("--plan", args.plan), ("--apply", args.apply), ("--daemon", args.daemon)) if enabled]
+    if len(modes) > 1:
+        parser.error(f"{' and '.join(modes)} can't be used together")
+    if (args.plan or args.apply) and args.use_async:
+        parser.error("--plan and --apply don't support --async")
+    if args.orphans and (args.dedupe or args.plan or args.apply):
+        parser.error("--orphans only applies to syncs")
+    if args.summary and (args.dedupe or args.plan or args.apply):
+        parser.error("--summary only applies to syncs")
+    if args.metrics and (args.dedupe or args.plan or args.apply):
+        parser.error("--metrics only applies to syncs")
+    if not 0 <= args.max_orphan_fraction <= 1:
+        parser.error("--max-orphan-fraction must be between 0 and 1")
+    return args
 
 # parse command-line arguments
 args = parse_args()
 
+# the asyncio transport needs the optional aiohttp dependency
+if args.use_async:
+    try:
+        import async_backend
+    except ImportError:
+        sys.exit("--async requires aiohttp: uv sync --extra async")
+
+# time spent per phase and per HTTP endpoint, reported with --profile
+profiler = Profiler()
+
 def handle_insecure_flag(insecure):
     if insecure:
         urllib3.disable_warnings(category=urllib3.exceptions.InsecureRequestWarning)
@@ -81,6 +163,8 @@ configuration.host = ELABFTW_HOST_URL
 configuration.debug = False
 # set verify_ssl based on flag Before creating ApiClient
 configuration.verify_ssl = not args.insecure
+# each worker needs its own connection to the eLabFTW host, otherwise urllib3 discards the extra ones
+configuration.connection_pool_maxsize = max(configuration.connection_pool_maxsize, args.workers)
 
 # setup proxy to elabapi client's config
 proxy_url = os.getenv("HTTPS_PROXY") or os.getenv("HTTP_PROXY")
@@ -103,18 +187,20 @@ api_client.set_default_header(header_name="X-Proxy-Trace", header_value="quartzy
 # Configure automatic retries on transient HTTP errors (e.g. brief connection drops, nginx reloads,
 # php-fpm restarts). This prevents the sync job from failing on temporary network/server issues.
 retry_strategy = Retry(
-    total=5, # total retries
-    backoff_factor=1, # exponential backoff (1, 2, 4, 8 etc.)
-    status_forcelist=[500, 502, 503, 504],
+    total=RETRY_TOTAL, # total retries
+    backoff_factor=RETRY_BACKOFF_FACTOR, # exponential backoff (1, 2, 4, 8 etc.)
+    status_forcelist=sorted(RETRY_STATUSES),
     # do not retry POST methods to prevent duplicate resource creation
-    allowed_methods=frozenset({'GET','PATCH'}),
+    allowed_methods=RETRY_METHODS,
 )
 
 api_client.rest_client.pool_manager.connection_pool_kw["retries"] = retry_strategy
+profiler.watch_rest_client(api_client.rest_client)
 
 itemsApi = elabapi_python.ItemsApi(api_client)
 resourcesCategoriesApi = elabapi_python.ResourcesCategoriesApi(api_client)
 infoApi = elabapi_python.InfoApi(api_client)
+tagsApi = elabapi_python.TagsApi(api_client)
 
 #########################
 #     Logging Setup     #
@@ -141,125 +227,177 @@ logging.debug(f"Categories allowed : {ALLOWED_CATEGORIES}")
 #   QUARTZY INVENTORY   #
 #########################
 
-# compare existing metadata & incoming metadata
-def metadata_changed(existing_metadata_raw, new_metadata_dict):
-    existing_metadata = json.loads(existing_metadata_raw) if isinstance(existing_metadata_raw, str) else existing_metadata_raw
-    existing_metadata_json = json.dumps(existing_metadata, sort_keys=True)
-    new_metadata_json = json.dumps(new_metadata_dict, sort_keys=True)
-
-    return existing_metadata_json != new_metadata_json
-
 # Quartzy public API authorizations (AccessToken)
 headers = {"Access-Token": QUARTZY_TOKEN, "Accept": "application/json"}
-# Fetch Quartzy inventory and filter
-quartzy_raw_items = fetch_all_quartzy_items(QUARTZY_API_INVENTORY_URL, headers, verbose=args.verbose)
-quartzy_items = [
-    item for item in quartzy_raw_items
-    if item.get("type", {}).get("name") in ALLOWED_CATEGORIES
-]
+quartzy_session = requests.Session()
+profiler.watch_session(quartzy_session)
+
+# --async: the Quartzy pages and the eLabFTW requests are sent from one event loop over aiohttp
+# every run goes through the same event loop, so the connections are kept between daemon runs
+async_runner = asyncio.Runner() if args.use_async else None
+async_transport = None
+
+def get_async_transport():
+    # created on first use, inside the event loop, and kept between daemon runs
+    global async_transport
+    if async_transport is None:
+        verify = False if args.insecure else (ca_path or True)
+        async_transport = async_backend.AsyncTransport(
+            ELABFTW_HOST_URL,
+            ELABFTW_API_KEY,
+            headers,
+            concurrency=args.workers,
+            fetch_concurrency=args.fetch_workers,
+            verify=verify,
+            profiler=profiler,
+        )
+    return async_transport
+
+#########################
+#   eLabFTW REQUESTS    #
+#########################
+# the eLabFTW logic is shared by the threaded and the --async runs: it is written as generators that yield the requests
+# to send, as (operation, *arguments), and get back their result, or the error they raised thrown into them.
+# run_requests sends them with the generated client, run_requests_async with the async transport.
+
+def location_id(resp_headers):
+    return int(resp_headers.get("Location", "").rstrip("/").split("/")[-1])
+
+def send_request(operation, *arguments):
+    if operation == "read_categories":
+        return {cat.title: cat.id for cat in resourcesCategoriesApi.read_team_resources_categories(TEAM_ID)}
+    if operation == "post_category":
+        _, _, resp_headers = resourcesCategoriesApi.post_team_one_rescat_with_http_info(TEAM_ID, body=arguments[0])
+        return location_id(resp_headers)
+    if operation == "read_items":
+        response = itemsApi.read_items(_preload_content=False, **arguments[0])
+        return json.loads(response.data.decode("utf-8"))
+    if operation == "post_item":
+        _, _, resp_headers = itemsApi.post_item_with_http_info(body=arguments[0])
+        return location_id(resp_headers)
+    if operation == "patch_item":
+        return itemsApi.patch_item(arguments[0], body=arguments[1])
+    if operation == "post_tag":
+        return tagsApi.post_tag("items", arguments[0], body=arguments[1])
+    raise ValueError(f"Unknown eLabFTW operation: {operation}")
+
+async def send_request_async(operation, *arguments):
+    transport = get_async_transport()
+    if operation == "read_categories":
+        return {cat["title"]: cat["id"] for cat in await transport.read_team_resources_categories(TEAM_ID)}
+    if operation == "post_category":
+        return await transport.post_team_one_rescat(TEAM_ID, arguments[0])
+    if operation == "read_items":
+        return await transport.read_items(**arguments[0])
+    if operation == "post_item":
+        return await transport.post_item(arguments[0])
+    if operation == "patch_item":
+        return await transport.patch_item(*arguments)
+    if operation == "post_tag":
+        return await transport.post_tag(*arguments)
+    raise ValueError(f"Unknown eLabFTW operation: {operation}")
+
+# returns the value returned by the generator
+def run_requests(flow):
+    answer = error = None
+    while True:
+        try:
+            request = flow.throw(error) if error else flow.send(answer)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            answer, error = send_request(*request), None
+        except Exception as e:
+            answer, error = None, e
 
-logging.debug(f"Total filtered Quartzy items: {len(quartzy_items)}")
+async def run_requests_async(flow):
+    answer = error = None
+    while True:
+        try:
+            request = flow.throw(error) if error else flow.send(answer)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            answer, error = await send_request_async(*request), None
+        except Exception as e:
+            answer, error = None, e
 
 #########################
 #      eLabFTW SYNC     #
 #########################
 
 # Category Sync
-try:
-    existing_categories = resourcesCategoriesApi.read_team_resources_categories(TEAM_ID)
-except Exception as e:
-    logging.exception(f"Failed to fetch resource categories: {e}")
-    sys.exit(1)
-category_id_map = {cat.title: cat.id for cat in existing_categories}
-new_categories = sorted(set(item["type"]["name"] for item in quartzy_items))
-
-logging.debug("Syncing resources categories...")
-
-for category in new_categories:
-    if category in category_id_map:
-        logging.debug(f"Category already exists: {category}")
-        continue
-    # generate random color for category
-    color = "#{:06x}".format(random.randint(0, 0xFFFFFF))
+# resource category title -> eLabFTW id, loaded and completed at the start of each run
+category_id_map = {}
+
+# the categories cached in the local index are used as long as they include every synced category,
+# they are listed from eLabFTW again on --rebuild-index and after an item creation rejected by eLabFTW (e.g. its category was deleted there)
+def cached_categories(rebuild=False):
+    if rebuild:
+        return None
+    categories = sync_index.load_categories()
+    if all(category in categories for category in ALLOWED_CATEGORIES):
+        logging.debug(f"Using {len(categories)} cached resource categories.")
+        return categories
+    return None
+
+def use_categories(categories):
+    category_id_map.clear()
+    category_id_map.update(categories)
+    sync_index.save_categories(category_id_map)
+
+def load_categories(rebuild=False):
+    categories = cached_categories(rebuild)
+    if categories is None:
+        try:
+            categories = yield ("read_categories",)
+        except Exception as e:
+            logging.exception(f"Failed to fetch resource categories: {e}")
+            raise
+    use_categories(categories)
+
+# synced categories that don't exist in eLabFTW yet
+def missing_categories():
+    return [category for category in ALLOWED_CATEGORIES if category not in category_id_map]
+
+# returns the id of the new category, or None if it couldn't be created
+def create_category(category):
     try:
-        _, status, resp_headers = resourcesCategoriesApi.post_team_one_rescat_with_http_info(
-            TEAM_ID,
-            body={"name": category, "color": color}
-        )
+        return (yield "post_category", {"name": category, "color": category_color(category)})
     except Exception as e:
         logging.exception(f"Failed to create category '{category}': {e}")
-        continue
-    if status == 201:
-        location = resp_headers.get("Location", "")
-        try:
-            new_id = int(location.rstrip("/").split("/")[-1])
-            category_id_map[category] = new_id
-            logging.debug(f"Created category: {category} (ID: {new_id})")
-        except Exception:
-            logging.exception(f"Couldn't parse ID from Location header: {location}")
-    else:
-        logging.error(f"Failed to create category '{category}', status: {status}")
+        return None
+
+# created is a dict of category -> new id (None on failure), the items of the categories that couldn't be created fail until the next run
+def add_created_categories(created):
+    for category, new_id in created.items():
+        if new_id is None:
+            continue
+        category_id_map[category] = new_id
+        logging.debug(f"Created category: {category} (ID: {new_id})")
+    if created:
+        sync_index.save_categories(category_id_map)
+
+# create all the missing synced categories at once, before any item is written
+def provision_categories():
+    missing = missing_categories()
+    if not missing:
+        return
+    with ThreadPoolExecutor(max_workers=min(len(missing), CATEGORY_WORKERS)) as executor:
+        add_created_categories(dict(zip(missing, executor.map(lambda category: run_requests(create_category(category)), missing))))
+
+async def provision_categories_async():
+    missing = missing_categories()
+    new_ids = await asyncio.gather(*(run_requests_async(create_category(category)) for category in missing))
+    add_created_categories(dict(zip(missing, new_ids)))
 
 def build_metadata(item):
     qid = item.get("id")
     if not qid:
         raise ValueError(f"[ERROR] Missing Quartzy ID for item: {item.get('name')}")
 
-    extra_fields = {
-        # keep unique identifier from quartzy to patch existing in eLabFTW
-        "Quartzy ID": {"type": "text", "value": qid},
-        "Name": {"type": "text", "value": item.get("name", "")},
-        "Vendor": {"type": "text", "value": item.get("vendor", "")},
-        "Catalog Number": {"type": "text", "value": item.get("catalog_number", "")},
-        # the quantity unit is not available via Quartzy API, neither are MIN/MAX to stock
-        "Quantity": {
-            "type": "number",
-            "units": [item.get("unit_size", "")],
-            "unit": item.get("unit_size", ""),
-            "value": item.get("quantity", "")
-        },
-        # the price unit is not available via Quartzy API
-        "Price": {
-            "type": "number",
-            "units": ["€", "$"],
-            "unit": "€",
-            "value": item.get("price", "")
-        },
-        "Open in Quartzy": {"type": "url", "value": item.get("app_url", "")},
-        "Public URL": {
-            "type": "url",
-            "description": "Origin URL of the item",
-            "value": item.get("url", "")
-        },
-        "Owner": {
-            "type": "text",
-            "value": f'{(item.get("added_by") or {}).get("first_name", "")} {(item.get("added_by") or {}).get("last_name", "")}'.strip()
-        },
-        "Owner Contact": {
-            "type": "email",
-            "value": (item.get("added_by") or {}).get("email", "")
-        },
-        "Cas Number": {"type": "text", "value": item.get("cas_number", "")},
-        "Lot Number": {"type": "text", "value": item.get("lot_number", "")},
-        "Serial Number": {"type": "text", "value": item.get("serial_number", "")},
-        "Location": {
-            "type": "text",
-            "value": (item.get("location") or {}).get("name", "")
-        },
-        "Sub-location": {
-            "type": "text",
-            "value": (item.get("sublocation") or {}).get("name", "")
-        },
-        "Technical details": {"type": "text", "value": item.get("technical_details", "")},
-        "Expiration Date": {"type": "text", "value": item.get("expiration_date", "")},
-        "Reminder Date": {
-            "type": "date",
-            "value": compute_reminder_date(item.get("expiration_date", ""), item.get("auto_reminder", ""))
-        }
-    }
-
-    # remove fields with no values
-    cleaned = {k: v for k, v in extra_fields.items() if v.get("value")}
+    # fields with no values are left out
+    cleaned = build_extra_fields(item)
 
     if not cleaned:
         raise ValueError(f"[ERROR] Empty metadata for item: {item.get('name')}")
@@ -269,124 +407,1010 @@ def build_metadata(item):
 #########################
 #   eLabFTW resources   #
 #########################
-logging.debug("Pushing Quartzy Inventory to eLabFTW...")
-existing_qid_map = {}
-
-try:
-    # todo: remove limit when eLabFTW instance is upgraded to latest versions: limit is removed when not passed explicitly
-    response = itemsApi.read_items(_preload_content=False, limit=99999)
-    items = json.loads(response.data.decode("utf-8"))
-except Exception as e:
-    logging.exception(f"Failed to fetch existing items: {e}")
-    sys.exit(1)
-
-for elab_item in items:
-    metadata_raw = elab_item.get("metadata")
-    if not metadata_raw:
-        continue
+# ids of the synced categories that exist in eLabFTW, as expected by the cat filter of read_items
+def synced_category_filter():
+    return ",".join(str(category_id_map[category]) for category in ALLOWED_CATEGORIES if category in category_id_map)
 
-    try:
-        # normalize to dict to use metadata
-        if isinstance(metadata_raw, str):
-            metadata = json.loads(metadata_raw)
-        else:
-            metadata = metadata_raw
+# an orphan archived or tagged by a previous run (or by hand), it isn't handled again
+# read_items lists the tags of an item as a single string, separated by "|"
+def is_orphaned(elab_item):
+    return elab_item.get("state") == ITEM_STATE_ARCHIVED or ORPHAN_TAG in (elab_item.get("tags") or "").split("|")
 
-        qid = metadata.get("extra_fields", {}).get("Quartzy ID", {}).get("value")
-        if qid:
-            existing_qid_map[qid] = elab_item
-        else:
+# add the items of one page of read_items with a Quartzy ID to existing, as ItemRecord
+# the first item found for a Quartzy ID is kept, the ids of the next ones are added to duplicates (qid -> [item ids])
+# the metadata is only kept when a metadata dict is given (qid -> metadata dict)
+def index_existing_page(items, existing, duplicates=None, metadata_by_qid=None):
+    for elab_item in items:
+        metadata_raw = elab_item.get("metadata")
+        if not metadata_raw:
             continue
+
+        try:
+            # normalize to dict to use metadata
+            if isinstance(metadata_raw, str):
+                metadata = json.loads(metadata_raw)
+            else:
+                metadata = metadata_raw
+
+            qid = metadata.get("extra_fields", {}).get("Quartzy ID", {}).get("value")
+            if not qid:
+                continue
+            if qid in existing:
+                # archived duplicates were already dealt with
+                if duplicates is not None and elab_item.get("state") != ITEM_STATE_ARCHIVED:
+                    duplicates.setdefault(qid, []).append(elab_item["id"])
+                continue
+            # the rest of the item (body, etc.) is not needed
+            existing[qid] = ItemRecord(elab_item["id"], metadata_fingerprint(metadata), bool(elab_item.get("locked")), is_orphaned(elab_item))
+            if metadata_by_qid is not None:
+                metadata_by_qid[qid] = metadata
+        except Exception as e:
+            logging.exception(f"Failed to parse metadata for item ID {elab_item.get('id')}: {e}")
+
+# Quartzy ID -> ItemRecord, read from the server
+# only the synced categories are requested, page by page, so memory stays bounded whatever the size of the team
+# items are read by increasing id, so when a Quartzy ID is found several times the oldest item is kept, like deduplicate.sql
+# state filters on the item state (e.g. "1" for normal items only), the server default otherwise
+def fetch_existing_items(duplicates=None, state=None, metadata_by_qid=None):
+    existing = {}
+    if duplicates is None:
+        duplicates = {}
+    category_filter = synced_category_filter()
+    if not category_filter:
+        logging.debug("No synced category in eLabFTW yet, no existing items to look for.")
+        return existing
+
+    filters = {"state": state} if state else {}
+    offset = 0
+    while True:
+        try:
+            items = yield "read_items", {
+                "cat": category_filter,
+                # stable order so items don't move between pages
+                "order": "id",
+                "sort": "asc",
+                "limit": ELABFTW_ITEMS_PAGE_SIZE,
+                "offset": offset,
+                **filters,
+            }
+        except Exception as e:
+            logging.exception(f"Failed to fetch existing items: {e}")
+            raise
+
+        index_existing_page(items, existing, duplicates, metadata_by_qid)
+        if len(items) < ELABFTW_ITEMS_PAGE_SIZE:
+            break
+        offset += len(items)
+
+    logging.debug(f"Found {len(existing)} existing items with Quartzy ID.")
+    warn_duplicates(duplicates)
+    return existing
+
+def warn_duplicates(duplicates):
+    if duplicates:
+        count = sum(len(item_ids) for item_ids in duplicates.values())
+        logging.warning(f"Found {count} duplicate item{'s' if count != 1 else ''} for {len(duplicates)} Quartzy ID{'s' if len(duplicates) != 1 else ''}, see --dedupe.")
+
+# the local index is only rebuilt from the server when empty, on --rebuild-index, when its fingerprints were computed differently,
+# or every --rebuild-index-every hours so the items deleted in eLabFTW are created again even when they don't change in Quartzy
+def index_needs_rebuild(rebuild):
+    outdated = sync_index.get_meta("fingerprint_version") != str(FINGERPRINT_VERSION)
+    built_at = sync_index.get_meta("index_built_at")
+    expired = args.rebuild_index_every and (not built_at or time.time() - float(built_at) >= args.rebuild_index_every * 3600)
+    return rebuild or outdated or expired or not len(sync_index)
+
+def rebuild_sync_index(existing):
+    sync_index.rebuild(existing)
+    sync_index.set_meta("fingerprint_version", FINGERPRINT_VERSION)
+    sync_index.set_meta("index_built_at", time.time())
+
+# Quartzy ID -> ItemRecord, with the fingerprint of the last pushed metadata
+def load_existing_qid_map(rebuild=False):
+    if index_needs_rebuild(rebuild):
+        logging.debug("Rebuilding the local sync index from eLabFTW...")
+        rebuild_sync_index((yield from fetch_existing_items()))
+    existing_qid_map = sync_index.load()
+    logging.debug(f"Found {len(existing_qid_map)} items in the local sync index.")
+    return existing_qid_map
+
+# what the eLabFTW server supports, detected once through InfoApi
+# eLabFTW accepts title, body and metadata when creating an item since 5.1
+FULL_POST_MIN_VERSION = 50100
+
+def detect_capabilities():
+    try:
+        info = infoApi.get_info()
+        version = info.elabftw_version_int or 0
     except Exception as e:
-        logging.exception(f"Failed to parse metadata for item ID {elab_item.get('id')}: {e}")
+        logging.warning(f"Couldn't read eLabFTW version, assuming an older server: {e}")
+        version = 0
+    capabilities = {"full_post": version >= FULL_POST_MIN_VERSION}
+    logging.debug(f"eLabFTW version {version}, capabilities: {capabilities}")
+    return capabilities
+
+with profiler.phase("detect_capabilities"):
+    server_capabilities = detect_capabilities()
 
-logging.debug(f"Found {len(existing_qid_map)} existing items with Quartzy ID.")
+# fewest requests needed to bring one item up to date, in the order they must be sent
+# "post" creates the item (with its content when the server allows it), "patch" sends title/body/metadata, "lock" forcelocks it
+def plan_requests(existing_item, fingerprint):
+    if existing_item is None:
+        if server_capabilities["full_post"]:
+            return ["post", "lock"]
+        return ["post", "patch", "lock"]
+    if fingerprint == existing_item.metadata_hash:
+        # no change in metadata, but the lock may not have gone through
+        return [] if existing_item.locked else ["lock"]
+    if existing_item.locked:
+        return ["patch"]
+    return ["patch", "lock"]
 
-created, updated = 0, 0
+# title, body and metadata sent to eLabFTW
+def build_content_payload(item, metadata):
+    body = ""
+    tech_details = item.get("technical_details")
+    if tech_details:
+        escaped = html.escape(tech_details).replace("\n", "<br>")
+        body = f"<h1>Technical details</h1>\n<p>{escaped}</p>"
 
-pbar = tqdm(quartzy_items, desc="Syncing Quartzy items", unit="item", disable=not args.verbose)
+    return {
+        "title": item["name"],
+        "body": body,
+        "metadata": json.dumps(metadata)
+    }
+
+# send the requests given by plan_requests for one item, each one recorded in the local index, returns the eLabFTW id of the item
+# item_id is None when the item is created, content_payload is only used by "post" and "patch"
+def send_item_requests(qid, cat_id, steps, item_id, content_payload, fingerprint):
+    for step in steps:
+        if step == "post":
+            # never retried (see retry_strategy) to avoid creating duplicates
+            post_payload = {"category": cat_id}
+            if "patch" not in steps:
+                post_payload.update(content_payload)
+            # if the response is lost, the next run looks for this item before creating it again
+            sync_index.journal("post", qid)
+            try:
+                item_id = yield "post_item", post_payload
+            except Exception as e:
+                if 400 <= (getattr(e, "status", None) or 0) < 500:
+                    sync_index.save_categories({})
+                raise
+            # indexed right away: if a later request fails, the next run patches this item instead of creating a new one
+            # when created without content, no hash is stored so the next run sees it as changed
+            sync_index.record(qid, item_id, fingerprint if "patch" not in steps else None, event="posted")
+        elif step == "patch":
+            yield "patch_item", item_id, content_payload
+            sync_index.record(qid, item_id, fingerprint, event="patched")
+        elif step == "lock":
+            yield "patch_item", item_id, {"action": "forcelock"}
+            sync_index.record(qid, item_id, fingerprint, locked=True, event="locked")
+    return item_id
 
-for item in pbar:
+def sync_item(item, metadata, fingerprint):
+    # create or update a single item in eLabFTW, metadata is the output of build_metadata and fingerprint its metadata_fingerprint
+    # the requests for one item are always sent in the order given by plan_requests
+    # returns "created", "updated", "failed" or None when nothing was done
+    name = item.get("name", "Unnamed")
     try:
-        name = item.get("name", "Unnamed")
         if args.verbose:
-            pbar.write(f"Handling item: {name}")
+            tqdm.write(f"Handling item: {name}")
 
         cat_name = item["type"]["name"]
         cat_id = category_id_map.get(cat_name)
+        # its category couldn't be created, the item is retried next run
         if not cat_id:
-            continue
+            profiler.add_failure("category_missing")
+            return "failed"
 
-        qid = item.get("id")
-        if not qid:
-            logging.warning(f"Skipping item '{item['name']}' (missing Quartzy ID)")
-            continue
+        qid = item["id"]
+        existing_item = existing_qid_map.get(qid)
+        steps = plan_requests(existing_item, fingerprint)
+        if not steps:
+            return None
 
-        body = ""
-        tech_details = item.get("technical_details")
-        if tech_details:
-            escaped = html.escape(tech_details).replace("\n", "<br>")
-            body = f"<h1>Technical details</h1>\n<p>{escaped}</p>"
-
-        if qid in existing_qid_map:
-            # PATCH existing item
-            existing_item = existing_qid_map[qid]
-            item_id = existing_item["id"]
-
-            existing_metadata_raw = existing_item.get("metadata")
-            existing_metadata = (
-                json.loads(existing_metadata_raw)
-                if isinstance(existing_metadata_raw, str)
-                else existing_metadata_raw
+        content_payload = build_content_payload(item, metadata)
+        try:
+            item_id = yield from send_item_requests(
+                qid, cat_id, steps, existing_item.item_id if existing_item else None, content_payload, fingerprint,
             )
+        except Exception as e:
+            # deleted in eLabFTW since it was indexed: dropped from the index and created again
+            if not existing_item or getattr(e, "status", None) != 404:
+                raise
+            logging.warning(f"Item {existing_item.item_id} was deleted in eLabFTW, creating '{name}' again")
+            sync_index.remove([qid])
+            existing_item = None
+            item_id = yield from send_item_requests(qid, cat_id, plan_requests(None, fingerprint), None, content_payload, fingerprint)
 
-            new_metadata_full = build_metadata(item)
-            new_metadata_dict = {
-                "extra_fields": new_metadata_full.get("extra_fields", {})
-            }
+        if existing_item:
+            logging.debug(f"Updated item '{item['name']}' (ID: {item_id})")
+            return "updated"
+        logging.debug(f"Created item '{item['name']}' (ID: {item_id})")
+        return "created"
+    except Exception as e:
+        logging.exception(f"Exception on item '{name}': {e}")
+        profiler.add_failure(failure_reason(e))
+        return "failed"
 
-            if not metadata_changed(existing_metadata_raw, new_metadata_dict):
-                continue  # Skip patching, no change in metadata
+#########################
+#       SYNC RUN        #
+#########################
+# the eLabFTW server and the team of the API key (TEAM_ID is "current"), the key itself is only kept hashed
+elabftw_context = hashlib.sha256(json.dumps([ELABFTW_HOST_URL, ELABFTW_API_KEY]).encode("utf-8")).hexdigest()
+sync_index = SyncIndex(os.path.join(args.state_dir, "index.sqlite"), elabftw_context)
+if sync_index.reset:
+    # the page cache marks go with it, see start_run
+    logging.warning("The local sync index was made for another eLabFTW server or API key, it will be rebuilt.")
+# Quartzy pages already synced are skipped as long as they don't change, and the settings that shape the eLabFTW items don't either
+page_cache_context = hashlib.sha256(json.dumps(
+    [elabftw_context, ALLOWED_CATEGORIES, field_mapping, FINGERPRINT_VERSION], sort_keys=True, ensure_ascii=False,
+).encode("utf-8")).hexdigest()
+page_cache = PageCache(
+    os.path.join(args.state_dir, "pages.sqlite"), int(args.page_cache_size * 1024 * 1024), page_cache_context,
+) if args.page_cache_size else None
+existing_qid_map = {}
+# the run in progress or the last one, for --metrics
+last_run = None
+# set on SIGTERM/SIGINT in daemon mode: no new item is started and the process exits after the current run
+stop_requested = threading.Event()
 
-            patch_payload = {
-                "title": item["name"],
-                "body": body,
-                "metadata": json.dumps(new_metadata_dict)
-            }
-            itemsApi.patch_item(item_id, body=patch_payload)
-            logging.debug(f"Updated item '{item['name']}' (ID: {item_id})")
-            updated += 1
-            itemsApi.patch_item(item_id, body={"action": "forcelock"})
+# the high-water mark is kept this many seconds before the start of the run: items edited while the pages were
+# fetched can be on pages read before, and the clock of this host may be ahead of Quartzy's
+HIGH_WATER_MARK_MARGIN = 600
+
+# bookkeeping of one sync run, shared by run_sync and run_sync_async
+def start_run(incremental=False, rebuild=False):
+    global last_run
+    logging.debug("Pushing Quartzy Inventory to eLabFTW...")
+    existing_qid_map.clear()
+
+    # incremental mode: items already in eLabFTW and not modified in Quartzy since the high-water mark are skipped
+    # a full sync (no high-water mark) still runs every --full-sync-every hours to catch anything missed
+    high_water_mark = None
+    if incremental and not rebuild:
+        last_full_sync = sync_index.get_meta("last_full_sync")
+        if last_full_sync and time.time() - float(last_full_sync) < args.full_sync_every * 3600:
+            high_water_mark = parse_timestamp(sync_index.get_meta("high_water_mark"))
+    logging.debug(f"Incremental sync from {high_water_mark}" if high_water_mark else "Full sync")
+
+    # the cached pages were synced against the index about to be rebuilt, which happens while the first pages are fetched
+    if page_cache and index_needs_rebuild(rebuild):
+        page_cache.clear_synced()
+
+    # a journal left behind by an interrupted run: its completed pages are skipped,
+    # and the items it was creating when it stopped are looked up before being created again
+    journal = sync_index.read_journal()
+    completed_page = max((page for event, _, _, page in journal if event == "page"), default=0)
+    posted = {qid for event, qid, _, _ in journal if event == "posted"}
+    lost_posts = sorted({qid for event, qid, _, _ in journal if event == "post" and qid not in posted})
+    if journal:
+        logging.warning(f"Resuming the interrupted sync after page {completed_page}, {len(lost_posts)} item creation{'s' if len(lost_posts) != 1 else ''} to check.")
+
+    last_run = {
+        "started": time.time(),
+        "counts": {"created": 0, "updated": 0, "failed": 0, "total": 0},
+        "high_water_mark": high_water_mark,
+        # most recent Quartzy modification seen during this run
+        "latest_update": high_water_mark,
+        "pbar": tqdm(desc="Syncing Quartzy items", unit="item", disable=not args.verbose),
+        # Quartzy IDs already handled by this run
+        "seen": set(),
+        "resumed": bool(journal),
+        "lost_posts": lost_posts,
+        "start_page": completed_page + 1,
+        # pages are journaled in order, once all their items went through: page -> items still being written
+        "completed_page": completed_page,
+        "enumerated_page": completed_page,
+        "outstanding": {},
+        # Quartzy IDs of the items that failed in the previous runs, never skipped by the high-water mark
+        "retries": sync_index.load_retries(),
+        # pages with failed items, not marked synced in the page cache
+        "failed_pages": set(),
+        # with the page cache: Quartzy IDs of the synced items of each page read in full but not marked synced yet
+        "page_qids": {},
+        # pages with items skipped by the high-water mark, left unmarked in the page cache for the next full sync
+        "unchecked_pages": set(),
+        # a page skipped by the page cache was evicted before its Quartzy IDs were read, orphans can't be found
+        "orphans_unknown": False,
+        "orphans_failed": 0,
+        # a Quartzy page that couldn't be fetched: the rest of the inventory wasn't read, the run fails once the items started are done
+        "fetch_error": None,
+        # set by finish_run
+        "finished": None,
+    }
+    return last_run
+
+# the newest items of the synced categories, where items created by an interrupted run are
+def read_newest_items():
+    category_filter = synced_category_filter()
+    if not category_filter:
+        return []
+    return (yield "read_items", {"cat": category_filter, "order": "id", "sort": "desc", "limit": ELABFTW_ITEMS_PAGE_SIZE})
+
+# index the items created by the interrupted run whose POST response was lost, matched by Quartzy ID,
+# then start a new journal. Only items created with their metadata can be found (see FULL_POST_MIN_VERSION),
+# the others are created again.
+def resume_run(run, newest_items):
+    found = {}
+    index_existing_page(newest_items, found)
+    for qid in run["lost_posts"]:
+        if qid in found:
+            record = found[qid]
+            sync_index.record(qid, record.item_id, record.metadata_hash, locked=record.locked)
+            logging.warning(f"Found item {record.item_id} created by the interrupted sync for Quartzy ID {qid}")
+    sync_index.reset_journal(run["completed_page"])
+
+def count_result(run, result):
+    # counters and progress bar are only touched from the main thread (or the event loop)
+    counts = run["counts"]
+    if result in counts:
+        counts[result] += 1
+    run["pbar"].update(1)
+    run["pbar"].set_postfix(created=counts["created"], updated=counts["updated"], refresh=False)
+
+# journal the pages whose items are all done, in order
+def checkpoint(run):
+    outstanding = run["outstanding"]
+    while run["completed_page"] < run["enumerated_page"] and not outstanding.get(run["completed_page"] + 1):
+        run["completed_page"] += 1
+        outstanding.pop(run["completed_page"], None)
+        sync_index.journal("page", page=run["completed_page"])
+
+# with the page cache: a page read in full is marked synced once its own items are done, if none of them failed
+def mark_page(run, page):
+    if page not in run["page_qids"] or run["outstanding"].get(page):
+        return
+    qids = run["page_qids"].pop(page)
+    if page not in run["failed_pages"]:
+        page_cache.mark_synced(page, qids)
+
+def item_started(run, page):
+    run["outstanding"][page] = run["outstanding"].get(page, 0) + 1
+
+# a failed item is kept in the retries of the local index until it goes through
+def item_done(run, page, qid, result):
+    run["outstanding"][page] -= 1
+    if result == "failed":
+        sync_index.add_retry(qid)
+        run["failed_pages"].add(page)
+    elif qid in run["retries"]:
+        sync_index.remove_retry(qid)
+    count_result(run, result)
+    mark_page(run, page)
+    checkpoint(run)
+
+# every item of the page was started or skipped, page_items is None for a page skipped by the page cache
+def page_done(run, page, page_items):
+    if page_items is None:
+        qids = page_cache.synced_qids(page)
+        if qids is None:
+            run["orphans_unknown"] = True
+        # its items are unchanged, and counted as such
+        qids = [qid for qid in qids or () if qid not in run["seen"]]
+        run["seen"].update(qids)
+        run["counts"]["total"] += len(qids)
+        run["pbar"].update(len(qids))
+    elif page_cache and page not in run["unchecked_pages"]:
+        run["page_qids"][page] = [
+            item["id"] for item in page_items if item.get("id") and item.get("type", {}).get("name") in ALLOWED_CATEGORIES
+        ]
+    run["enumerated_page"] = page
+    mark_page(run, page)
+    checkpoint(run)
+
+# whether a Quartzy item needs to go through sync_item, skipped items are counted here
+def select_item(run, page, item):
+    if item.get("type", {}).get("name") not in ALLOWED_CATEGORIES:
+        return False
+    # Quartzy pages can shift during a run: an item seen twice would be created twice, as it is only indexed once created
+    qid = item.get("id")
+    if qid in run["seen"]:
+        return False
+    run["counts"]["total"] += 1
+    if not qid:
+        logging.warning(f"Skipping item '{item.get('name', 'Unnamed')}' (missing Quartzy ID)")
+        count_result(run, None)
+        return False
+    run["seen"].add(qid)
+    updated_at = parse_timestamp(item.get("updated_at"))
+    if updated_at and (run["latest_update"] is None or updated_at > run["latest_update"]):
+        run["latest_update"] = updated_at
+    # new items are always pushed, whatever their modification date
+    high_water_mark = run["high_water_mark"]
+    if high_water_mark and updated_at and updated_at <= high_water_mark and qid in existing_qid_map and qid not in run["retries"]:
+        # not compared with eLabFTW, so the page can't be marked synced in the page cache
+        run["unchecked_pages"].add(page)
+        count_result(run, None)
+        return False
+    return True
+
+def prepare_item(item):
+    with profiler.phase("build_metadata"):
+        metadata = build_metadata(item)
+        return metadata, metadata_fingerprint(metadata)
+
+def tag_orphan(item_id):
+    try:
+        yield "post_tag", item_id, {"tag": ORPHAN_TAG}
+        return True
+    except Exception as e:
+        logging.exception(f"Failed to tag item {item_id}: {e}")
+        return False
+
+# --orphans: the indexed items whose Quartzy ID wasn't seen in the synced categories by a complete run
+# (deleted in Quartzy, or moved to a type that isn't synced) are archived or tagged, then removed from the index
+# the orphans handled before and indexed again by a rebuild are left alone, and don't count in --max-orphan-fraction
+# returns the orphans to handle, Quartzy ID -> eLabFTW item id, the ones left untouched are counted in orphans_failed
+def find_orphans(run):
+    if run["resumed"] or run["orphans_unknown"] or run["fetch_error"] or stop_requested.is_set():
+        logging.debug("Not looking for orphans, this run didn't read every Quartzy item.")
+        return {}
+    orphans = {qid: record.item_id for qid, record in existing_qid_map.items() if qid not in run["seen"] and not record.orphaned}
+    # e.g. a Quartzy account or a CATEGORIES entry that changed by mistake
+    synced = sum(not record.orphaned for record in existing_qid_map.values())
+    if len(orphans) > args.max_orphan_fraction * synced:
+        logging.error(
+            f"Found {len(orphans)} orphan items out of {synced}, more than --max-orphan-fraction {args.max_orphan_fraction}: leaving them untouched."
+        )
+        run["orphans_failed"] = len(orphans)
+        return {}
+    return orphans
+
+# the request archiving or tagging an orphan, returns whether it went through
+def handle_orphan(item_id):
+    return archive_item(item_id) if args.orphans == "archive" else tag_orphan(item_id)
+
+# results tells for each of the orphans whether it was handled
+def orphans_handled(run, orphans, results):
+    if not orphans:
+        return
+    sync_index.remove([qid for qid, done in zip(orphans, results) if done])
+    logging.warning(f"{'Archived' if args.orphans == 'archive' else 'Tagged'} {results.count(True)}/{len(orphans)} orphan items.")
+    run["orphans_failed"] = results.count(False)
+
+# --summary: read by sync_targets.py for its per target summary
+def write_summary(run, failed):
+    summary = {
+        **run["counts"],
+        "failed": failed,
+        "seconds": round(run["finished"] - run["started"], 3),
+        "incremental": run["high_water_mark"] is not None,
+        "resumed": run["resumed"],
+        "interrupted": stop_requested.is_set(),
+    }
+    try:
+        with open(args.summary, "w") as f:
+            json.dump(summary, f)
+            f.write("\n")
+    except OSError as e:
+        logging.error(f"Failed to write the summary to {args.summary}: {e}")
+
+# saves the high-water mark and logs the summary, returns the number of failed items
+def finish_run(run):
+    run["pbar"].close()
+
+    counts = run["counts"]
+    created, updated, failed, total = counts["created"], counts["updated"], counts["failed"], counts["total"]
+    # the high-water mark only moves forward when the whole inventory was read, failed items are retried next run
+    if failed:
+        logging.error(f"{failed} item{'s' if failed != 1 else ''} failed to sync, retrying {'them' if failed != 1 else 'it'} next run.")
+    if run["fetch_error"]:
+        logging.error("The Quartzy inventory couldn't be read to the end, keeping the previous high-water mark.")
+    elif stop_requested.is_set():
+        logging.warning("Sync interrupted, keeping the previous high-water mark.")
+    elif run["resumed"]:
+        # the pages skipped by this run may have changed since, only a complete run moves the high-water mark
+        logging.warning("Resumed sync done, keeping the previous high-water mark.")
+    else:
+        if run["latest_update"]:
+            started = datetime.fromtimestamp(run["started"] - HIGH_WATER_MARK_MARGIN, timezone.utc)
+            sync_index.set_meta("high_water_mark", min(run["latest_update"], started).isoformat())
+        if run["high_water_mark"] is None:
+            sync_index.set_meta("last_full_sync", time.time())
+        # every item to retry was seen by this run, the ones that didn't fail again are gone from Quartzy or its synced categories
+        sync_index.prune_retries(run["started"])
+    # the next run starts from the first page, or resumes after the last page read in full
+    if not stop_requested.is_set() and not run["fetch_error"]:
+        sync_index.reset_journal()
+    failed += run["orphans_failed"]
+    run["finished"] = time.time()
+    if args.summary:
+        write_summary(run, failed)
+
+    logging.debug(f"Total filtered Quartzy items: {total}")
+
+    if created == 0:
+        logging.debug(f"Done: {created}/{total} item{'s' if total != 1 else ''} needed import.")
+    else:
+        logging.debug(f"Done: {created}/{total} item{'s' if created != 1 else ''} successfully imported.")
+    if updated == 0:
+        logging.debug(f"Done: {updated}/{total} item{'s' if total != 1 else ''} needed update.")
+    else:
+        logging.debug(f"Done: {updated}/{total} item{'s' if updated != 1 else ''} successfully updated.")
+    return failed
+
+# the items of a page that go to sync_item, as (item, metadata, fingerprint), the others are counted here
+# page_items is None for a page skipped by the page cache
+def page_sync_tasks(run, page, page_items):
+    for item in page_items or ():
+        if stop_requested.is_set():
+            return
+        if not select_item(run, page, item):
+            continue
+        item_started(run, page)
+        try:
+            metadata, fingerprint = prepare_item(item)
+        except Exception as e:
+            logging.exception(f"Exception on item '{item.get('name', 'Unnamed')}': {e}")
+            profiler.add_failure(failure_reason(e))
+            item_done(run, page, item["id"], "failed")
+            continue
+        yield item, metadata, fingerprint
+
+# one full pass over the Quartzy inventory, returns the number of failed items
+def run_sync(incremental=False, rebuild=False):
+    run = start_run(incremental, rebuild)
+    # every synced category exists before the existing items are loaded and the first item is written
+    with profiler.phase("read_categories"):
+        run_requests(load_categories(rebuild))
+    with profiler.phase("create_categories"):
+        provision_categories()
+    with profiler.phase("resume"):
+        resume_run(run, run_requests(read_newest_items()) if run["lost_posts"] else [])
+    # summed over all workers
+    timed_item = profiler.timed("item_writes", run_requests)
+
+    # stream the Quartzy inventory: pages are filtered and turned into metadata as they arrive,
+    # so eLabFTW writes start with the first page instead of waiting for the whole inventory
+    def iter_sync_tasks(existing_items):
+        pages = profiler.iterate("inventory_fetch", iter_quartzy_pages(
+            QUARTZY_API_INVENTORY_URL, headers, concurrency=args.fetch_workers, verbose=args.verbose, session=quartzy_session,
+            start_page=run["start_page"], cache=page_cache,
+        ))
+        try:
+            for page, page_items in enumerate(pages, start=run["start_page"]):
+                if page == run["start_page"]:
+                    # the first page is fetched while the existing items load, writes need both
+                    with profiler.phase("wait_existing_items"):
+                        existing_qid_map.update(existing_items.result())
+                for task in page_sync_tasks(run, page, page_items):
+                    yield page, *task
+                if stop_requested.is_set():
+                    return
+                page_done(run, page, page_items)
+        except QuartzyFetchError as e:
+            run["fetch_error"] = e
+
+    def sync_page_item(page, item, metadata, fingerprint):
+        return page, item["id"], timed_item(sync_item(item, metadata, fingerprint))
+
+    with ThreadPoolExecutor(max_workers=1) as loader:
+        tasks = iter_sync_tasks(loader.submit(profiler.timed("load_existing_items", run_requests), load_existing_qid_map(rebuild)))
+        if args.workers == 1:
+            for task in tasks:
+                item_done(run, *sync_page_item(*task))
         else:
-            # POST new item (only with category_id)
-            _, status_code, headers = itemsApi.post_item_with_http_info(body={
-                "category": cat_id
-            })
-            location = headers.get("Location", "")
-            item_id = int(location.rstrip("/").split("/")[-1])
-
-            # PATCH with metadata, title, and body
-            patch_payload = {
-                "title": item["name"],
-                "body": body,
-                "metadata": json.dumps(build_metadata(item))
-            }
-            itemsApi.patch_item(item_id, body=patch_payload)
-            logging.debug(f"Created item '{item['name']}' (ID: {item_id})")
-            created += 1
-            itemsApi.patch_item(item_id, body={"action": "forcelock"})
+            # items are independent from each other, so they can be synced concurrently over the shared pool manager
+            # only a few items are queued per worker, to keep memory flat however large the inventory is
+            with ThreadPoolExecutor(max_workers=args.workers) as executor:
+                pending = set()
+                for task in tasks:
+                    if len(pending) >= args.workers * 2:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            item_done(run, *future.result())
+                    pending.add(executor.submit(sync_page_item, *task))
+                for future in as_completed(pending):
+                    item_done(run, *future.result())
+
+    if args.orphans:
+        orphans = find_orphans(run)
+        with profiler.phase("orphans"), ThreadPoolExecutor(max_workers=args.workers) as executor:
+            orphans_handled(run, orphans, list(executor.map(lambda item_id: run_requests(handle_orphan(item_id)), orphans.values())))
+
+    failed = finish_run(run)
+    if run["fetch_error"]:
+        raise run["fetch_error"]
+    return failed
+
+#########################
+#     ASYNC SYNC RUN    #
+#########################
+# same as run_sync, the requests are sent from the event loop
+async def run_sync_async(incremental=False, rebuild=False):
+    run = start_run(incremental, rebuild)
+    with profiler.phase("read_categories"):
+        await run_requests_async(load_categories(rebuild))
+    with profiler.phase("create_categories"):
+        await provision_categories_async()
+    with profiler.phase("resume"):
+        resume_run(run, (await run_requests_async(read_newest_items())) if run["lost_posts"] else [])
+    existing_items = asyncio.create_task(profiler.timed_async("load_existing_items", run_requests_async)(load_existing_qid_map(rebuild)))
+    timed_item = profiler.timed_async("item_writes", run_requests_async)
+    # --workers items are in flight at once (the transport also caps the requests), a few more are queued
+    pending = set()
+
+    async def sync_page_item(page, item, metadata, fingerprint):
+        return page, item["id"], await timed_item(sync_item(item, metadata, fingerprint))
+
+    def collect(done):
+        for task in done:
+            item_done(run, *task.result())
+
+    try:
+        pages = get_async_transport().iter_quartzy_pages(QUARTZY_API_INVENTORY_URL, start_page=run["start_page"], cache=page_cache)
+        page = run["start_page"]
+        try:
+            async for page_items in profiler.aiterate("inventory_fetch", pages):
+                if page == run["start_page"]:
+                    with profiler.phase("wait_existing_items"):
+                        existing_qid_map.update(await existing_items)
+                for item, metadata, fingerprint in page_sync_tasks(run, page, page_items):
+                    if len(pending) >= args.workers * 2:
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        collect(done)
+                    pending.add(asyncio.create_task(sync_page_item(page, item, metadata, fingerprint)))
+                if stop_requested.is_set():
+                    break
+                page_done(run, page, page_items)
+                page += 1
+        except QuartzyFetchError as e:
+            run["fetch_error"] = e
+        if pending:
+            done, pending = await asyncio.wait(pending)
+            collect(done)
+        # the index is rebuilt even when Quartzy has no item, like with run_sync
+        await existing_items
+    finally:
+        if not existing_items.done():
+            existing_items.cancel()
+
+    if args.orphans:
+        orphans = find_orphans(run)
+        with profiler.phase("orphans"):
+            orphans_handled(run, orphans, list(await asyncio.gather(*(run_requests_async(handle_orphan(item_id)) for item_id in orphans.values()))))
+
+    failed = finish_run(run)
+    if run["fetch_error"]:
+        raise run["fetch_error"]
+    return failed
+
+#########################
+#        DEDUPE         #
+#########################
+# --dedupe: the items created several times for the same Quartzy ID are found while reading the synced categories,
+# the oldest one is kept and indexed, the others are listed and, with "archive", archived through the API
+# (archived items keep their links to experiments)
+def archive_item(item_id):
+    try:
+        yield "patch_item", item_id, {"action": "archive"}
+        return True
+    except Exception as e:
+        logging.exception(f"Failed to archive item {item_id}: {e}")
+        return False
+
+# returns the number of duplicates left
+def run_dedupe(archive=False):
+    with profiler.phase("read_categories"):
+        run_requests(load_categories())
+    duplicates = {}
+    # already archived items are not counted
+    with profiler.phase("load_existing_items"):
+        existing = run_requests(fetch_existing_items(duplicates, state="1"))
+
+    for qid, item_ids in duplicates.items():
+        kept = existing[qid]
+        # next syncs update the kept item
+        sync_index.record(qid, kept.item_id, kept.metadata_hash, locked=kept.locked)
+        print(f"Quartzy ID {qid}: keeping item {kept.item_id}, duplicates: {', '.join(str(item_id) for item_id in item_ids)}")
+    extra_ids = [item_id for item_ids in duplicates.values() for item_id in item_ids]
+    print(f"{len(extra_ids)} duplicate item{'s' if len(extra_ids) != 1 else ''} for {len(duplicates)} Quartzy ID{'s' if len(duplicates) != 1 else ''}.")
+    if not archive or not extra_ids:
+        return 0
+
+    with profiler.phase("archive_duplicates"), ThreadPoolExecutor(max_workers=args.workers) as executor:
+        archived = sum(executor.map(lambda item_id: run_requests(archive_item(item_id)), extra_ids))
+    print(f"Archived {archived}/{len(extra_ids)} duplicate items.")
+    return len(extra_ids) - archived
+
+#########################
+#      PLAN / APPLY     #
+#########################
+# --plan compares the whole Quartzy inventory with the items read from eLabFTW (not the local index), without writing anything,
+# and lists the requests a sync would send. --apply sends them as planned, without comparing again.
+PLAN_VERSION = 1
+
+# number of requests of a plan, and how long they should take with --workers at the eLabFTW latency measured while planning
+def estimate_plan(plan):
+    actions = plan["creates"] + plan["updates"] + plan["locks"]
+    requests = {
+        "POST resources_categories": len(plan["create_categories"]),
+        "POST items": sum(action["steps"].count("post") for action in actions),
+        "PATCH items": sum(len(action["steps"]) - action["steps"].count("post") for action in actions),
+    }
+    total = sum(requests.values())
+    latency = profiler.median_latency(ELABFTW_HOST_URL.split("://", 1)[-1])
+    return {
+        "requests": requests,
+        "total_requests": total,
+        "workers": args.workers,
+        "request_seconds": round(latency, 4) if latency else None,
+        "seconds": round(total * latency / args.workers, 1) if latency else None,
+    }
 
-            pbar.set_postfix(created=created, updated=updated, refresh=False)
+def build_plan():
+    with profiler.phase("read_categories"):
+        run_requests(load_categories(rebuild=True))
+    # the metadata is kept to list the changed fields
+    metadata_by_qid = {}
+    with profiler.phase("load_existing_items"):
+        existing = run_requests(fetch_existing_items(metadata_by_qid=metadata_by_qid))
+
+    plan = {
+        "version": PLAN_VERSION,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "elabftw_host_url": ELABFTW_HOST_URL,
+        "categories": ALLOWED_CATEGORIES,
+        "create_categories": missing_categories(),
+        "creates": [],
+        "updates": [],
+        "locks": [],
+        # items in eLabFTW whose Quartzy ID isn't in the synced categories of the inventory anymore, see --orphans
+        "orphans": [],
+        # items whose metadata couldn't be built
+        "errors": [],
+    }
+    quartzy_ids = set()
+    # orphans can only be told apart when every page was read
+    pages = profiler.iterate("inventory_fetch", iter_quartzy_pages(
+        QUARTZY_API_INVENTORY_URL, headers, concurrency=args.fetch_workers, verbose=args.verbose, session=quartzy_session,
+    ))
+    for page_items in pages:
+        for item in page_items:
+            qid = item.get("id")
+            category = (item.get("type") or {}).get("name")
+            if not qid or qid in quartzy_ids or category not in ALLOWED_CATEGORIES:
+                continue
+            quartzy_ids.add(qid)
+            name = item.get("name", "Unnamed")
+            try:
+                metadata, fingerprint = prepare_item(item)
+            except Exception as e:
+                plan["errors"].append({"qid": qid, "name": name, "error": str(e)})
+                continue
+
+            record = existing.get(qid)
+            if record is None:
+                plan["creates"].append({
+                    "qid": qid, "name": name, "category": category,
+                    "steps": plan_requests(None, fingerprint), "fingerprint": fingerprint, "payload": build_content_payload(item, metadata),
+                })
+                continue
+            steps = plan_requests(record, fingerprint)
+            if "patch" in steps:
+                plan["updates"].append({
+                    "qid": qid, "name": name, "item_id": record.item_id, "changed_fields": changed_fields(metadata_by_qid[qid], metadata),
+                    "steps": steps, "fingerprint": fingerprint, "payload": build_content_payload(item, metadata),
+                })
+            elif steps:
+                plan["locks"].append({"qid": qid, "name": name, "item_id": record.item_id, "steps": steps, "fingerprint": fingerprint})
+
+    plan["orphans"] = [
+        {"qid": qid, "name": metadata_by_qid[qid].get("extra_fields", {}).get("Name", {}).get("value", ""), "item_id": record.item_id}
+        for qid, record in existing.items() if qid not in quartzy_ids and not record.orphaned
+    ]
+    plan["estimate"] = estimate_plan(plan)
+    return plan
+
+def run_plan():
+    plan = build_plan()
+    estimate = plan["estimate"]
+    duration = f", about {estimate['seconds']:.0f}s with {estimate['workers']} worker{'s' if estimate['workers'] != 1 else ''}" if estimate["seconds"] is not None else ""
+    summary = (
+        f"Plan: {len(plan['create_categories'])} categor{'ies' if len(plan['create_categories']) != 1 else 'y'} to create, {len(plan['creates'])} items to create, "
+        f"{len(plan['updates'])} to update, {len(plan['locks'])} to lock, {len(plan['orphans'])} orphans, "
+        f"{len(plan['errors'])} errors: {estimate['total_requests']} requests{duration}."
+    )
+    if args.plan == '-':
+        print(json.dumps(plan, indent=2, ensure_ascii=False))
+        logging.info(summary)
+    else:
+        with open(args.plan, "w") as f:
+            json.dump(plan, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+        print(summary)
+
+def apply_action(action, cat_id):
+    try:
+        if args.verbose:
+            tqdm.write(f"Handling item: {action['name']}")
+        run_requests(send_item_requests(action["qid"], cat_id, action["steps"], action.get("item_id"), action.get("payload"), action["fingerprint"]))
+        return True
     except Exception as e:
-        logging.exception(f"Exception on item '{name}': {e}")
+        logging.exception(f"Exception on item '{action['name']}': {e}")
+        return False
 
-total = len(quartzy_items)
+# returns the number of planned items that couldn't be synced
+def run_apply(path):
+    try:
+        with open(path) as f:
+            plan = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        sys.exit(f"Failed to read the plan {path}: {e}")
+    if plan.get("version") != PLAN_VERSION:
+        sys.exit(f"Unsupported plan version {plan.get('version')}, make a new plan with --plan")
+    if plan["elabftw_host_url"] != ELABFTW_HOST_URL:
+        sys.exit(f"The plan was made for {plan['elabftw_host_url']}, not {ELABFTW_HOST_URL}")
+    if plan["categories"] != ALLOWED_CATEGORIES:
+        sys.exit("The plan was made with other CATEGORIES, make a new plan with --plan")
+    # the lost creations of an interrupted run are only looked for by a sync
+    if sync_index.read_journal():
+        sys.exit("An interrupted sync needs to be resumed first, run main.py without --apply")
 
-if created == 0:
-    logging.debug(f"Done: {created}/{total} item{'s' if total != 1 else ''} needed import.")
-else:
-    logging.debug(f"Done: {created}/{total} item{'s' if created != 1 else ''} successfully imported.")
-if updated == 0:
-    logging.debug(f"Done: {updated}/{total} item{'s' if total != 1 else ''} needed update.")
+    with profiler.phase("read_categories"):
+        run_requests(load_categories())
+    with profiler.phase("create_categories"):
+        provision_categories()
+
+    failed = 0
+    # a sync that ran after the plan may have created some of the items already
+    indexed = sync_index.load()
+    tasks = []
+    for action in plan["creates"]:
+        if action["qid"] in indexed:
+            logging.warning(f"Not creating '{action['name']}': Quartzy ID {action['qid']} was synced after the plan was made")
+            continue
+        cat_id = category_id_map.get(action["category"])
+        if not cat_id:
+            logging.error(f"Not creating '{action['name']}': category '{action['category']}' doesn't exist")
+            failed += 1
+            continue
+        tasks.append((action, cat_id))
+    tasks += [(action, None) for action in plan["updates"] + plan["locks"]]
+
+    with profiler.phase("item_writes"), ThreadPoolExecutor(max_workers=args.workers) as executor:
+        results = list(tqdm(
+            executor.map(lambda task: apply_action(*task), tasks), total=len(tasks), desc="Applying plan", unit="item", disable=not args.verbose,
+        ))
+    failed += results.count(False)
+    sync_index.reset_journal()
+    print(f"Applied {results.count(True)}/{len(tasks)} planned items.")
+    if failed:
+        logging.error(f"{failed} planned item{'s' if failed != 1 else ''} failed to sync.")
+    return failed
+
+def write_profile():
+    report = json.dumps(profiler.report(), indent=2)
+    if args.profile == '-':
+        print(report)
+    else:
+        with open(args.profile, "w") as f:
+            f.write(report + "\n")
+
+# --metrics: items/s, requests, retries, bytes and failure reasons of the last run, also written when it failed
+def write_metrics():
+    run = last_run
+    report = profiler.report()
+    counts = run["counts"] if run else {"created": 0, "updated": 0, "failed": 0, "total": 0}
+    if not run or not run["finished"] or run["fetch_error"]:
+        status = "error"
+    elif run["counts"]["failed"] or run["orphans_failed"]:
+        status = "failed"
+    elif stop_requested.is_set():
+        status = "interrupted"
+    else:
+        status = "ok"
+    seconds = (run["finished"] or time.time()) - run["started"] if run else report["wall_seconds"]
+    requests = report["requests"]
+    metrics = {
+        "timestamp": round(time.time(), 3),
+        **({"target": SYNC_TARGET} if SYNC_TARGET else {}),
+        "elabftw_host_url": ELABFTW_HOST_URL,
+        "status": status,
+        "incremental": bool(run and run["high_water_mark"]),
+        "seconds": round(seconds, 3),
+        "items": {
+            "created": counts["created"],
+            "updated": counts["updated"],
+            "failed": counts["failed"],
+            "unchanged": counts["total"] - counts["created"] - counts["updated"] - counts["failed"],
+        },
+        "items_per_second": round(counts["total"] / seconds, 2) if seconds else 0,
+        "orphans_failed": run["orphans_failed"] if run else 0,
+        "retries": sum(data["retries"] for data in requests.values()),
+        "rate_limited": sum(data["statuses"].get("429", 0) for data in requests.values()),
+        "bytes_sent": sum(data["bytes_sent"] for data in requests.values()),
+        "bytes_received": sum(data["bytes_received"] for data in requests.values()),
+        "requests": {
+            endpoint: {key: data[key] for key in ("statuses", "retries", "bytes_sent", "bytes_received", "p50", "p90", "p99")}
+            for endpoint, data in requests.items()
+        },
+        "failures": report["failures"],
+    }
+    try:
+        if args.metrics.endswith(".prom"):
+            # the textfile collector may read the file at any time, so it is replaced at once
+            with open(f"{args.metrics}.tmp", "w") as f:
+                f.write(prometheus_text(metrics))
+            os.replace(f"{args.metrics}.tmp", args.metrics)
+        else:
+            with open(args.metrics, "a") as f:
+                f.write(json.dumps(metrics) + "\n")
+    except OSError as e:
+        logging.error(f"Failed to write the metrics to {args.metrics}: {e}")
+
+def sync_once(incremental=False, rebuild=False):
+    global last_run
+    last_run = None
+    if async_runner:
+        return async_runner.run(run_sync_async(incremental=incremental, rebuild=rebuild))
+    return run_sync(incremental=incremental, rebuild=rebuild)
+
+if args.dedupe:
+    try:
+        if run_dedupe(archive=args.dedupe == "archive"):
+            sys.exit(1)
+    except Exception:
+        sys.exit(1)
+    finally:
+        if args.profile:
+            write_profile()
+elif args.plan:
+    try:
+        run_plan()
+    except Exception:
+        sys.exit(1)
+    finally:
+        if args.profile:
+            write_profile()
+elif args.apply:
+    try:
+        if run_apply(args.apply):
+            sys.exit(1)
+    except Exception:
+        sys.exit(1)
+    finally:
+        if args.profile:
+            write_profile()
+elif args.daemon:
+    # the eLabFTW pool manager, the Quartzy session and the local index (with the cached categories) are kept between runs
+    def request_stop(signum, frame):
+        logging.warning(f"Received signal {signum}, stopping after the current sync.")
+        stop_requested.set()
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    rebuild = args.rebuild_index
+    while not stop_requested.is_set():
+        profiler.reset()
+        try:
+            sync_once(incremental=True, rebuild=rebuild)
+            rebuild = False
+        except Exception as e:
+            # keep the daemon alive, the next run starts over
+            logging.exception(f"Sync failed: {e}")
+        if args.profile:
+            write_profile()
+        if args.metrics:
+            write_metrics()
+        stop_requested.wait(args.interval * 60)
 else:
-    logging.debug(f"Done: {updated}/{total} item{'s' if updated != 1 else ''} successfully updated.")
+    try:
+        sync_once(incremental=args.incremental, rebuild=args.rebuild_index)
+    except Exception:
+        sys.exit(1)
+    finally:
+        if args.profile:
+            write_profile()
+        if args.metrics:
+            write_metrics()
+
+if async_runner:
+    if async_transport:
+        async_runner.run(async_transport.aclose())
+    async_runner.close()
+sync_index.close()
+if page_cache:
+    page_cache.close()
+quartzy_session.close()
@@ -0,0 +1,365 @@
+# state.py
+# local state kept between runs, so a sync doesn't need to rebuild everything from the eLabFTW server
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+def default_state_dir():
+    # STATE_DIR env, or the XDG state directory (~/.local/state/quartzy2elabftw)
+    if os.getenv("STATE_DIR"):
+        return os.getenv("STATE_DIR")
+    state_home = os.getenv("XDG_STATE_HOME") or os.path.join(os.path.expanduser("~"), ".local", "state")
+    return os.path.join(state_home, "quartzy2elabftw")
+
+# what the sync needs to know about an item already in eLabFTW, held for every synced item:
+# slots keep it at a fraction of the size of a dict, the metadata itself is only kept as its fingerprint
+class ItemRecord:
+    __slots__ = ("item_id", "metadata_hash", "locked", "orphaned")
+
+    # orphaned: already archived or tagged as an orphan in eLabFTW, see --orphans
+    def __init__(self, item_id, metadata_hash, locked=False, orphaned=False):
+        self.item_id = item_id
+        self.metadata_hash = metadata_hash
+        self.locked = locked
+        self.orphaned = orphaned
+
+    def __repr__(self):
+        return f"ItemRecord({self.item_id!r}, {self.metadata_hash!r}, locked={self.locked!r}, orphaned={self.orphaned!r})"
+
+# Quartzy ID -> eLabFTW item id, hash of the last pushed metadata, lock and orphan state, and time of the last sync
+# writes are committed right away (autocommit), as a created item missing from the index would be created again on next run
+# context identifies the eLabFTW server and team the items were synced to: an index made for another one is emptied,
+# and reset tells the caller so
+class SyncIndex:
+    def __init__(self, path, context=""):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # shared by the sync workers
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "qid TEXT PRIMARY KEY, "
+            "item_id INTEGER NOT NULL, "
+            "metadata_hash TEXT, "
+            "synced_at REAL, "
+            "locked INTEGER NOT NULL DEFAULT 0, "
+            "orphaned INTEGER NOT NULL DEFAULT 0)"
+        )
+        # indexes created before the lock state was tracked
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(items)")}
+        if "locked" not in columns:
+            self.conn.execute("ALTER TABLE items ADD COLUMN locked INTEGER NOT NULL DEFAULT 0")
+            # these items were always locked right after their metadata was pushed
+            self.conn.execute("UPDATE items SET locked = 1 WHERE metadata_hash IS NOT NULL")
+        # and before the orphans were, found again when the index is rebuilt
+        if "orphaned" not in columns:
+            self.conn.execute("ALTER TABLE items ADD COLUMN orphaned INTEGER NOT NULL DEFAULT 0")
+        # run bookkeeping, e.g. the incremental sync high-water mark
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        # append-only progress of the current run: "post" is written before creating an item, then "posted", "patched"
+        # and "locked" after each request, and "page" once every item of a Quartzy page is done
+        # it is emptied at the end of a run, so a journal left behind means the previous run was interrupted
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS journal ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "event TEXT NOT NULL, "
+            "qid TEXT, "
+            "item_id INTEGER, "
+            "page INTEGER, "
+            "at REAL NOT NULL)"
+        )
+        # resource category title -> eLabFTW id, so later runs don't need to list them
+        self.conn.execute("CREATE TABLE IF NOT EXISTS categories (title TEXT PRIMARY KEY, category_id INTEGER NOT NULL)")
+        # Quartzy IDs of the items that failed to sync, retried by the next runs whatever their modification date
+        self.conn.execute("CREATE TABLE IF NOT EXISTS retries (qid TEXT PRIMARY KEY, failed_at REAL NOT NULL)")
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'context'").fetchone()
+        self.reset = False
+        if not row or row[0] != context:
+            # indexes created before the context was kept are emptied too, they can't be told apart
+            self.reset = any(
+                self.conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone()
+                for table in ("items", "meta", "journal", "categories", "retries")
+            )
+            self.conn.execute("BEGIN")
+            try:
+                for table in ("items", "meta", "journal", "categories", "retries"):
+                    self.conn.execute(f"DELETE FROM {table}")
+                self.conn.execute("INSERT INTO meta (key, value) VALUES ('context', ?)", (context,))
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    # Quartzy ID -> ItemRecord, used as existing_qid_map
+    def load(self):
+        with self.lock:
+            # rows are read from the cursor one at a time, rather than as a list next to the dict
+            return {
+                qid: ItemRecord(item_id, metadata_hash, bool(locked), bool(orphaned))
+                for qid, item_id, metadata_hash, locked, orphaned in self.conn.execute("SELECT qid, item_id, metadata_hash, locked, orphaned FROM items")
+            }
+
+    # locked is only ever set: patching a locked item doesn't unlock it
+    # with an event, the journal entry is written in the same transaction
+    def record(self, qid, item_id, metadata_hash, locked=False, event=None):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.execute(
+                    "INSERT INTO items (qid, item_id, metadata_hash, synced_at, locked) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(qid) DO UPDATE SET item_id = excluded.item_id, metadata_hash = excluded.metadata_hash, "
+                    "synced_at = excluded.synced_at, locked = MAX(locked, excluded.locked)",
+                    (qid, item_id, metadata_hash, now, int(locked)),
+                )
+                if event:
+                    self.conn.execute(
+                        "INSERT INTO journal (event, qid, item_id, at) VALUES (?, ?, ?, ?)",
+                        (event, qid, item_id, now),
+                    )
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def journal(self, event, qid=None, item_id=None, page=None):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO journal (event, qid, item_id, page, at) VALUES (?, ?, ?, ?, ?)",
+                (event, qid, item_id, page, time.time()),
+            )
+
+    # list of (event, qid, item_id, page), oldest first
+    def read_journal(self):
+        with self.lock:
+            return self.conn.execute("SELECT event, qid, item_id, page FROM journal ORDER BY seq").fetchall()
+
+    # start a new journal, keeping the last completed page of an interrupted run if any
+    def reset_journal(self, completed_page=0):
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.execute("DELETE FROM journal")
+                if completed_page:
+                    self.conn.execute(
+                        "INSERT INTO journal (event, page, at) VALUES ('page', ?, ?)",
+                        (completed_page, time.time()),
+                    )
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    # e.g. orphans archived in eLabFTW
+    def remove(self, qids):
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany("DELETE FROM items WHERE qid = ?", ((qid,) for qid in qids))
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    # replace the whole index with what is on the server: records is a dict of qid -> ItemRecord
+    def rebuild(self, records):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.execute("DELETE FROM items")
+                self.conn.executemany(
+                    "INSERT INTO items (qid, item_id, metadata_hash, synced_at, locked, orphaned) VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        (qid, record.item_id, record.metadata_hash, now, int(record.locked), int(record.orphaned))
+                        for qid, record in records.items()
+                    ),
+                )
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def load_categories(self):
+        with self.lock:
+            return dict(self.conn.execute("SELECT title, category_id FROM categories").fetchall())
+
+    # replace the cached categories, an empty dict makes the next run list them from eLabFTW again
+    def save_categories(self, categories):
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.execute("DELETE FROM categories")
+                self.conn.executemany("INSERT INTO categories (title, category_id) VALUES (?, ?)", categories.items())
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def load_retries(self):
+        with self.lock:
+            return {qid for qid, in self.conn.execute("SELECT qid FROM retries")}
+
+    def add_retry(self, qid):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO retries (qid, failed_at) VALUES (?, ?) ON CONFLICT(qid) DO UPDATE SET failed_at = excluded.failed_at",
+                (qid, time.time()),
+            )
+
+    def remove_retry(self, qid):
+        with self.lock:
+            self.conn.execute("DELETE FROM retries WHERE qid = ?", (qid,))
+
+    # the items that didn't fail again since before, e.g. deleted in Quartzy
+    def prune_retries(self, before):
+        with self.lock:
+            self.conn.execute("DELETE FROM retries WHERE failed_at < ?", (before,))
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, str(value)),
+            )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# Quartzy inventory pages of the previous runs, by page number
+# validators (ETag, Last-Modified) are sent back so Quartzy can answer 304 Not Modified, and the sha256 of the body
+# tells whether a page changed when it doesn't: a page whose content is the one last synced completely doesn't need to be processed again
+# context identifies the settings the pages were synced with (e.g. the field mapping), pages synced with other settings are processed again
+# bodies are stored compressed, the least recently used pages are evicted once they take more than max_bytes
+class PageCache:
+    def __init__(self, path, max_bytes, context=""):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # shared by the page fetchers
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # synced_hash is the content_hash of the page when all its items last went through, qids the Quartzy IDs synced from it (JSON list)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "page INTEGER PRIMARY KEY, "
+            "etag TEXT, "
+            "last_modified TEXT, "
+            "content_hash TEXT NOT NULL, "
+            "synced_hash TEXT, "
+            "body BLOB NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "used_at REAL NOT NULL, "
+            "qids TEXT)"
+        )
+        # caches created before the Quartzy IDs were kept: their pages are synced again
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(pages)")}
+        if "qids" not in columns:
+            self.conn.execute("ALTER TABLE pages ADD COLUMN qids TEXT")
+            self.conn.execute("UPDATE pages SET synced_hash = NULL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'context'").fetchone()
+        if not row or row[0] != context:
+            self.conn.execute("UPDATE pages SET synced_hash = NULL")
+            self.conn.execute("INSERT INTO meta (key, value) VALUES ('context', ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value", (context,))
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+
+    # the cached page as a dict, or None
+    def get(self, page):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT etag, last_modified, content_hash, synced_hash, body FROM pages WHERE page = ?", (page,)
+            ).fetchone()
+            if not row:
+                return None
+            self.conn.execute("UPDATE pages SET used_at = ? WHERE page = ?", (time.time(), page))
+        etag, last_modified, content_hash, synced_hash, body = row
+        return {"etag": etag, "last_modified": last_modified, "content_hash": content_hash, "synced_hash": synced_hash, "body": body}
+
+    # headers making the request for a cached page conditional
+    @staticmethod
+    def conditional_headers(entry):
+        headers = {}
+        if entry and entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    # store the response to a request sent with conditional_headers(entry), status being 200 or 304
+    # returns the body of the page, and whether it is the content that was last synced
+    def resolve(self, page, entry, status, headers, body):
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if status == 304:
+            # a 304 can update the validators
+            with self.lock:
+                self.conn.execute(
+                    "UPDATE pages SET etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified) WHERE page = ?",
+                    (etag, last_modified, page),
+                )
+            return zlib.decompress(entry["body"]), entry["synced_hash"] == entry["content_hash"]
+
+        content_hash = hashlib.sha256(body).hexdigest()
+        with self.lock:
+            if entry and entry["content_hash"] == content_hash:
+                self.conn.execute("UPDATE pages SET etag = ?, last_modified = ? WHERE page = ?", (etag, last_modified, page))
+                return body, entry["synced_hash"] == content_hash
+            compressed = zlib.compress(body, 1)
+            previous = self.conn.execute("SELECT size FROM pages WHERE page = ?", (page,)).fetchone()
+            # a changed page needs to be synced again
+            self.conn.execute(
+                "INSERT INTO pages (page, etag, last_modified, content_hash, synced_hash, body, size, used_at) VALUES (?, ?, ?, ?, NULL, ?, ?, ?) "
+                "ON CONFLICT(page) DO UPDATE SET etag = excluded.etag, last_modified = excluded.last_modified, "
+                "content_hash = excluded.content_hash, synced_hash = NULL, body = excluded.body, size = excluded.size, used_at = excluded.used_at",
+                (page, etag, last_modified, content_hash, compressed, len(compressed), time.time()),
+            )
+            self.size += len(compressed) - (previous[0] if previous else 0)
+            self.evict()
+        return body, False
+
+    # drop the least recently used pages until the cache fits in max_bytes, called with the lock held
+    def evict(self):
+        if self.size <= self.max_bytes:
+            return
+        for page, size in self.conn.execute("SELECT page, size FROM pages ORDER BY used_at").fetchall():
+            self.conn.execute("DELETE FROM pages WHERE page = ?", (page,))
+            self.size -= size
+            if self.size <= self.max_bytes:
+                break
+
+    # every item of the page went through, qids are the Quartzy IDs of the synced items it holds
+    def mark_synced(self, page, qids):
+        with self.lock:
+            self.conn.execute("UPDATE pages SET synced_hash = content_hash, qids = ? WHERE page = ?", (json.dumps(qids), page))
+
+    # Quartzy IDs of a page yielded as already synced, None if it was evicted since
+    def synced_qids(self, page):
+        with self.lock:
+            row = self.conn.execute("SELECT qids FROM pages WHERE page = ? AND synced_hash IS NOT NULL", (page,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    # e.g. when the local index is rebuilt, every page is processed again on the next run
+    def clear_synced(self):
+        with self.lock:
+            self.conn.execute("UPDATE pages SET synced_hash = NULL")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
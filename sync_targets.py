@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# © Deltablot 2025
+# License: MIT
+
+# This script syncs several Quartzy inventories to eLabFTW in one run, e.g. one per lab with its own tokens and categories.
+# Each target of the config file is synced by its own main.py process, all at the same time, with its local index in a
+# subfolder of the state dir. The --workers and --fetch-workers limits are per host: they are split in slots, and each target
+# takes one slot of its eLabFTW host and one of its Quartzy host until it ends (see host_slots).
+import argparse
+import contextlib
+import json
+import os
+import queue
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from dotenv import load_dotenv
+from state import default_state_dir
+
+load_dotenv()
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+# environment variables of main.py that can be set per target
+TARGET_ENV = ("QUARTZY_TOKEN", "QUARTZY_API_INVENTORY_URL", "CATEGORIES", "FIELD_MAPPING", "ELABFTW_HOST_URL", "ELABFTW_API_KEY", "CA_PATH")
+REQUIRED_ENV = ("QUARTZY_TOKEN", "CATEGORIES", "ELABFTW_HOST_URL", "ELABFTW_API_KEY")
+# same default as main.py
+QUARTZY_API_INVENTORY_URL = os.getenv('QUARTZY_API_INVENTORY_URL') or 'https://api.quartzy.com/inventory-items'
+# main.py options set by this script for each target, or that don't make sense for several targets at once
+RESERVED_OPTIONS = ("--state-dir", "--summary", "--daemon", "--dedupe", "--plan", "--apply")
+
+#########################
+#     ArgumentParser    #
+#########################
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Sync several Quartzy inventories to eLabFTW at once, the other options are passed to main.py (e.g. --incremental, --orphans tag)",
+    )
+    parser.add_argument('config', help="JSON file listing the targets, see README.md")
+    parser.add_argument('--workers', type=int, default=8, help="Number of items synced concurrently with each eLabFTW host, split between the targets using it (default: 8)")
+    parser.add_argument('--fetch-workers', type=int, default=8, help="Number of Quartzy pages requested concurrently, split between the targets (default: 8)")
+    parser.add_argument('--parallel', type=int, help="Number of targets synced at the same time (default: all of them)")
+    parser.add_argument('--state-dir', default=default_state_dir(), help="Directory holding the local sync index of each target, in a subfolder named after it (default: STATE_DIR env or ~/.local/state/quartzy2elabftw)")
+    args, main_args = parser.parse_known_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.fetch_workers < 1:
+        parser.error("--fetch-workers must be at least 1")
+    if args.parallel is not None and args.parallel < 1:
+        parser.error("--parallel must be at least 1")
+    for option in main_args:
+        if option.split("=")[0] in RESERVED_OPTIONS:
+            parser.error(f"{option.split('=')[0]} can't be used with several targets")
+    return args, main_args
+
+# {target} in the value of --metrics is replaced by the name of each target, e.g. to write one Prometheus file per target
+def target_args(name):
+    return [option.replace("{target}", name) for option in main_args]
+
+args, main_args = parse_args()
+
+#########################
+#        TARGETS        #
+#########################
+
+# {"targets": [{"name": "lab-a", "QUARTZY_TOKEN": "...", ...}], ...}: the keys next to "targets" are shared by all of them
+def load_targets(path):
+    try:
+        with open(path) as f:
+            config = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        sys.exit(f"Failed to read {path}: {e}")
+    if not isinstance(config, dict) or not isinstance(config.get("targets"), list) or not config["targets"]:
+        sys.exit(f"{path} must be an object with a non-empty \"targets\" array")
+    defaults = {key: value for key, value in config.items() if key != "targets"}
+
+    targets = []
+    for number, target in enumerate(config["targets"], start=1):
+        if not isinstance(target, dict):
+            sys.exit(f"Target {number} must be an object")
+        target = {**defaults, **target}
+        # the name is also the folder of the local index of the target
+        name = target.pop("name", None)
+        if not isinstance(name, str) or not re.fullmatch(r"[\w.-]+", name) or name in (".", ".."):
+            sys.exit(f"Target {number} needs a name made of letters, digits, '.', '-' and '_'")
+        if name in (other["name"] for other in targets):
+            sys.exit(f"Several targets are named '{name}'")
+        unknown = sorted(set(target) - set(TARGET_ENV))
+        if unknown:
+            sys.exit(f"Unknown key{'s' if len(unknown) != 1 else ''} in target '{name}': {', '.join(unknown)}")
+        missing = [key for key in REQUIRED_ENV if not target.get(key)]
+        if missing:
+            sys.exit(f"Target '{name}' is missing {', '.join(missing)}")
+        # lists and objects (CATEGORIES, FIELD_MAPPING) are passed as JSON like in the .env file, null unsets a shared key
+        env = {key: "" if value is None else value if isinstance(value, str) else json.dumps(value) for key, value in target.items()}
+        targets.append({"name": name, "env": env})
+    return targets
+
+def host(url):
+    return urlsplit(url).netloc.lower()
+
+# host -> queue of the slots of its limit, one per target that can run on it at the same time, the sizes add up to the limit
+# a host with more targets than its limit has one slot of 1 per unit, and its other targets wait for a slot to be free
+# the sizes are fixed: the slot of a target that ends goes to the next one, it isn't split between the ones still running
+def host_slots(limit, targets, key):
+    running = args.parallel or len(targets)
+    slots = {}
+    for name, users in Counter(key(target) for target in targets).items():
+        count = min(users, limit, running)
+        slots[name] = queue.Queue()
+        for number in range(count):
+            slots[name].put(limit // count + (number < limit % count))
+    return slots
+
+targets = load_targets(args.config)
+# the Prometheus file of main.py is replaced at the end of each run, the JSON lines can go to the same file
+if len(targets) > 1 and any(option.endswith(".prom") and "{target}" not in option for option in main_args):
+    sys.exit("With several targets, the .prom file of --metrics needs {target} in its name, e.g. quartzy2elabftw_{target}.prom")
+quartzy_host = lambda target: host(target["env"].get("QUARTZY_API_INVENTORY_URL") or QUARTZY_API_INVENTORY_URL)
+elabftw_host = lambda target: host(target["env"]["ELABFTW_HOST_URL"])
+elabftw_slots = host_slots(args.workers, targets, elabftw_host)
+quartzy_slots = host_slots(args.fetch_workers, targets, quartzy_host)
+
+#########################
+#        SYNC RUN       #
+#########################
+
+output_lock = threading.Lock()
+processes = {}
+
+# forward to the running syncs, e.g. docker stop only signals this process
+def forward_signal(signum, frame):
+    for process in list(processes.values()):
+        process.send_signal(signum)
+signal.signal(signal.SIGTERM, forward_signal)
+
+# runs main.py for one target once it has a slot on both hosts, returns its exit code and the summary of the run (None if it didn't get to the end)
+# the eLabFTW slot is always taken first, so two targets can't each hold the slot the other one waits for
+def run_target(target):
+    workers = elabftw_slots[elabftw_host(target)].get()
+    try:
+        fetch_workers = quartzy_slots[quartzy_host(target)].get()
+        try:
+            return sync_target(target, workers, fetch_workers)
+        finally:
+            quartzy_slots[quartzy_host(target)].put(fetch_workers)
+    finally:
+        elabftw_slots[elabftw_host(target)].put(workers)
+
+def sync_target(target, workers, fetch_workers):
+    name = target["name"]
+    state_dir = os.path.join(args.state_dir, name)
+    summary_path = os.path.join(state_dir, "summary.json")
+    os.makedirs(state_dir, exist_ok=True)
+    # the summary of a previous run must not be reported for this one
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(summary_path)
+
+    command = [
+        sys.executable, os.path.join(ROOT_DIR, "main.py"), *target_args(name),
+        "--state-dir", state_dir, "--summary", summary_path,
+        "--workers", str(workers), "--fetch-workers", str(fetch_workers),
+    ]
+    # the keys a target doesn't set are emptied, so the .env file read by main.py doesn't apply to every target
+    env = {**os.environ, **{key: "" for key in TARGET_ENV}, **target["env"], "SYNC_TARGET": name}
+    process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    processes[name] = process
+    # the output of each target is prefixed with its name, progress bars only show up when they end a line
+    for line in process.stdout:
+        line = re.sub(r"\x1b\[[0-9;]*[A-Za-z]", "", line.decode(errors="replace").rstrip("\n").split("\r")[-1])
+        if not line.strip():
+            continue
+        with output_lock:
+            print(f"[{name}] {line}", file=sys.stderr, flush=True)
+    returncode = process.wait()
+    del processes[name]
+
+    try:
+        with open(summary_path) as f:
+            return returncode, json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return returncode, None
+
+def print_summary(results, seconds):
+    print(f"{'Target':<20} {'Status':<16} {'Created':>8} {'Updated':>8} {'Failed':>8} {'Total':>8} {'Seconds':>8}")
+    for target, (returncode, summary) in zip(targets, results):
+        if returncode:
+            status = f"error (exit {returncode})"
+        elif summary is None:
+            status = "no summary"
+        elif summary["failed"]:
+            status = "failed items"
+        elif summary["interrupted"]:
+            status = "interrupted"
+        else:
+            status = "ok"
+        counts = [summary[key] for key in ("created", "updated", "failed", "total", "seconds")] if summary else ["-"] * 5
+        print(f"{target['name']:<20} {status:<16} " + " ".join(f"{count:>8}" for count in counts))
+    print(f"{len(targets)} target{'s' if len(targets) != 1 else ''} synced in {seconds:.1f}s")
+
+start = time.time()
+with ThreadPoolExecutor(max_workers=args.parallel or len(targets)) as executor:
+    results = list(executor.map(run_target, targets))
+print_summary(results, time.time() - start)
+
+if any(returncode or summary is None or summary["failed"] for returncode, summary in results):
+    sys.exit(1)
@@ -1,9 +1,13 @@
 # utils.py
 
+import functools
 import logging
 
 # using local imports since each utils are reused elsewhere
 
+# memoized: an inventory has few distinct (expiration date, reminder) pairs, so the dates are only parsed once per pair
+# an invalid date or reminder is only logged the first time it is seen
+@functools.lru_cache(maxsize=4096)
 def compute_reminder_date(expiration_date_str, auto_reminder):
     # convert the "auto_reminder" from Quartzy API to a date.
     # e.g expiration_date = 2025-06-28, auto_reminder = "2 WEEK" > converted to "2025-06-13"
@@ -30,57 +34,516 @@ def compute_reminder_date(expiration_date_str, auto_reminder):
 
     return reminder_date.strftime("%Y-%m-%d")
 
-# fetch all quartzy items, while taking into account the pagination
-def fetch_all_quartzy_items(api_url, headers, per_page=25, max_pages=80, verbose=False):
-    # currently, there are like 45 pages. Can be updated accordingly in the future
-    # api doesn't allow fetching only the pages to see how much there are
+# parse an ISO 8601 timestamp from the Quartzy API (e.g. "2025-06-28T09:12:44Z"), None if missing or invalid
+def parse_timestamp(value):
+    from datetime import datetime, timezone
+
+    if not value:
+        return None
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        logging.warning(f"Invalid timestamp: {value}")
+        return None
+    # naive timestamps are considered UTC so they can be compared with the others
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp
+
+# color of a resource category, derived from its name so creating it again always gives the same color
+def category_color(name):
+    import hashlib
+
+    return "#" + hashlib.sha256(name.encode("utf-8")).hexdigest()[:6]
+
+# bump when the normalization below changes, so fingerprints stored in the local index are recomputed
+FINGERPRINT_VERSION = 1
+
+# stable hash of the extra fields produced by build_metadata, to detect changes with a single comparison
+# values are normalized first so the same content always gives the same fingerprint, whether it comes from
+# Quartzy or back from eLabFTW: numbers sent as strings ("12.50" vs 12.5) and the order of the units list
+def metadata_fingerprint(metadata):
+    import hashlib
+    import json
+
+    serialized = json.dumps(normalize_extra_fields(metadata), sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+# extra field name -> field, normalized for metadata_fingerprint
+def normalize_extra_fields(metadata):
+    from decimal import Decimal, InvalidOperation
+
+    normalized = {}
+    for name, field in (metadata.get("extra_fields") or {}).items():
+        field = dict(field)
+        value = field.get("value")
+        if field.get("type") == "number" and value not in (None, ""):
+            try:
+                value = format(Decimal(str(value).strip()).normalize(), "f")
+            except InvalidOperation:
+                value = str(value).strip()
+        elif value is not None:
+            value = str(value)
+        field["value"] = value
+        if isinstance(field.get("units"), list):
+            field["units"] = sorted(str(unit) for unit in field["units"])
+        normalized[name] = field
+    return normalized
+
+# names of the extra fields added, removed or modified between two metadata, compared like metadata_fingerprint does
+def changed_fields(old_metadata, new_metadata):
+    old = normalize_extra_fields(old_metadata)
+    new = normalize_extra_fields(new_metadata)
+    return sorted(name for name in old.keys() | new.keys() if old.get(name) != new.get(name))
+
+# retry policy on transient eLabFTW errors (e.g. brief connection drops, nginx reloads, php-fpm restarts),
+# shared by the urllib3 Retry of the generated client and the async backend
+RETRY_TOTAL = 5
+RETRY_BACKOFF_FACTOR = 1
+RETRY_STATUSES = frozenset({500, 502, 503, 504})
+# do not retry POST methods to prevent duplicate resource creation
+RETRY_METHODS = frozenset({"GET", "PATCH"})
+
+# seconds to wait before the given retry (1 for the first one), same as urllib3: no wait, then 2, 4, 8...
+def retry_backoff(retry_number):
+    if retry_number <= 1:
+        return 0
+    return RETRY_BACKOFF_FACTOR * 2 ** (retry_number - 1)
+
+# parse a Retry-After header, which is either a number of seconds or an HTTP date
+def parse_retry_after(value):
+    from datetime import datetime, timezone
+    from email.utils import parsedate_to_datetime
+
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        logging.warning(f"Invalid Retry-After header: {value}")
+        return None
+
+# token bucket shared by the page fetchers, adapting its rate to the server:
+# the rate is halved on every 429 and raised again a little for every successful request
+class TokenBucket:
+    def __init__(self, rate=5.0, min_rate=0.5, max_rate=20.0, capacity=2.0):
+        import threading
+        import time
+
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.capacity = capacity
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.throttled_at = 0.0
+        self.lock = threading.Lock()
+
+    # take a token if one is available: returns 0, or the number of seconds to wait before trying again
+    def reserve(self):
+        import time
+
+        with self.lock:
+            now = time.monotonic()
+            if now < self.updated:
+                # paused by a Retry-After
+                return self.updated - now
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + 0.5)
+
+    def on_throttled(self, retry_after=None):
+        import time
+
+        with self.lock:
+            now = time.monotonic()
+            # requests already in flight get throttled together: only slow down once per second
+            if now - self.throttled_at > 1:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.throttled_at = now
+            self.tokens = 0.0
+            if retry_after:
+                # no token is refilled before the server allows us to come back
+                self.updated = max(self.updated, now + retry_after)
+
+class QuartzyFetchError(Exception):
+    pass
+
+# the requests for one Quartzy page, shared by iter_quartzy_pages and the async transport, which only send them:
+# yields the seconds to wait before sending (rate limit), or the headers of the request to send and gets back (status, headers, body)
+# with a state.PageCache the request is conditional, and the answer is resolved against the cached page
+# returns (status, body, synced): body is None when the page couldn't be fetched, synced tells it is the content last synced
+def quartzy_page_requests(page, headers, bucket, cache=None, max_attempts=5):
+    entry = cache.get(page) if cache else None
+    if cache:
+        headers = {**headers, **cache.conditional_headers(entry)}
+    # a 429 is only returned once max_attempts is reached
+    for attempt in range(max_attempts):
+        while wait := bucket.reserve():
+            yield wait
+        status, response_headers, body = yield headers
+        if status != 429:
+            bucket.on_success()
+            break
+        retry_after = parse_retry_after(response_headers.get("Retry-After"))
+        if retry_after is None:
+            retry_after = 2 ** attempt
+        logging.warning(f"Rate limited by Quartzy on page {page}, retrying in {retry_after:.1f}s")
+        bucket.on_throttled(retry_after)
+    if status not in ((200, 304) if cache else (200,)):
+        return status, None, False
+    if not cache:
+        return status, body, False
+    body, synced = cache.resolve(page, entry, status, response_headers, body)
+    return status, body, synced
+
+# the items of a page answered by quartzy_page_requests, None for a page already synced, and an empty list past the last page
+def quartzy_page_items(page, status, body, synced):
+    import json
+
+    if body is None:
+        logging.error(f"Failed to fetch page {page}: {status}")
+        raise QuartzyFetchError(f"Failed to fetch page {page}: {status}")
+    if synced:
+        return None
+    page_items = json.loads(body)
+    if not isinstance(page_items, list):
+        logging.error(f"Unexpected response format on page {page}")
+        raise QuartzyFetchError(f"Unexpected response format on page {page}")
+    if not page_items:
+        logging.info(f"No more items to fetch (Page {page}).")
+    return page_items
+
+# yield the quartzy inventory page by page, while taking into account the pagination
+# the api doesn't tell how many pages there are, so several pages are requested ahead
+# and we stop at the first empty one
+# a requests.Session can be given to reuse its connections and hooks, otherwise a new one is used for this fetch
+# start_page skips the pages before it, e.g. to resume an interrupted sync
+# with a state.PageCache, requests are conditional and the pages whose content was already synced are yielded as None, without being parsed
+# raises QuartzyFetchError on a page that can't be fetched: the rest of the inventory would be missing
+def iter_quartzy_pages(api_url, headers, per_page=25, concurrency=4, verbose=False, session=None, start_page=1, cache=None):
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    from contextlib import nullcontext
     from tqdm import tqdm
     import requests
-    all_items = []
-    page = 1
+    import time
 
-    if verbose:
-        pbar = tqdm(total=max_pages, desc="Fetching inventory", unit="page")
-    else:
-        pbar = None
+    pbar = tqdm(desc="Fetching inventory", unit="page") if verbose else None
+    bucket = TokenBucket()
+    fetched = 0
+    unchanged = 0
 
-    while page <= max_pages:
-        if verbose:
-            pbar.set_description(f"Fetching page {page}")
+    # sends the requests of quartzy_page_requests
+    def fetch(page):
+        page_requests = quartzy_page_requests(page, headers, bucket, cache)
+        answer = None
+        while True:
+            try:
+                request = page_requests.send(answer)
+            except StopIteration as stop:
+                return stop.value
+            if isinstance(request, dict):
+                response = session.get(api_url, headers=request, params={"page": page, "per_page": per_page})
+                answer = (response.status_code, response.headers, response.content)
+            else:
+                time.sleep(request)
+                answer = None
 
-        response = requests.get(api_url, headers=headers, params={"page": page, "per_page": per_page})
-        if response.status_code != 200:
-            if verbose:
-                pbar.write(f"\nQuartzy API failed on page {page}: {response.status_code}")
-            logging.error(f"Failed to fetch page {page}: {response.status_code}")
-            break
+    with (nullcontext(session) if session else requests.Session()) as session, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # a session reused across fetches keeps its adapter, and the connections in it
+        if api_url not in session.adapters:
+            session.mount(api_url, requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+        pending = deque()
+        next_page = start_page
 
-        page_items = response.json()
-        if not isinstance(page_items, list):
-            if verbose:
-                pbar.write("\nUnexpected response format")
-            logging.error(f"Unexpected response format on page {page}")
-            break
+        def submit():
+            nonlocal next_page
+            pending.append((next_page, executor.submit(fetch, next_page)))
+            next_page += 1
 
-        if not page_items:
+        for _ in range(concurrency):
+            submit()
+
+        try:
+            # pages are consumed in order, whatever order they arrive in
+            while pending:
+                page, future = pending.popleft()
+                if verbose:
+                    pbar.set_description(f"Fetching page {page}")
+
+                try:
+                    page_items = quartzy_page_items(page, *future.result())
+                except requests.RequestException as e:
+                    logging.error(f"Failed to fetch page {page}: {e}")
+                    raise QuartzyFetchError(f"Failed to fetch page {page}: {e}") from e
+                if page_items is None:
+                    unchanged += 1
+                elif not page_items:
+                    break
+                else:
+                    fetched += len(page_items)
+                submit()
+                if verbose:
+                    pbar.update(1)
+                yield page_items
+        finally:
+            # pages requested past the end are not needed anymore
+            for _, future in pending:
+                future.cancel()
             if verbose:
-                pbar.write("\nNo more items to fetch.")
-            logging.info(f"No more items to fetch (Page {page}).")
-            break
+                pbar.close()
+
+    if not verbose:
+        logging.info(f"Total fetched: {fetched} items, {unchanged} unchanged page{'s' if unchanged != 1 else ''} skipped.")
 
-        all_items.extend(page_items)
-        page += 1
-        if verbose:
-            pbar.update(1)
+# "GET /api/v2/items/{id}" style name of a request, so requests to the same endpoint are grouped together
+def endpoint_name(method, url):
+    from urllib.parse import urlparse
 
-        # Avoid rate limiting or getting blocked for 429: too many requests.
+    parsed = urlparse(url)
+    path = "/".join("{id}" if segment.isdigit() else segment for segment in parsed.path.split("/"))
+    return f"{method.upper()} {parsed.netloc}{path}"
+
+# short reason of a failed item for the metrics: the HTTP status when eLabFTW answered, else the exception type
+# (with the cause of a urllib3 MaxRetryError, e.g. "MaxRetryError: NewConnectionError")
+def failure_reason(e):
+    status = getattr(e, "status", None)
+    if status:
+        return f"http_{status}"
+    reason = getattr(e, "reason", None)
+    if isinstance(reason, Exception):
+        return f"{type(e).__name__}: {type(reason).__name__}"
+    return type(e).__name__
+
+# wall time per phase of a sync run, count/latency/status/retries/bytes of the HTTP requests per endpoint, and reasons of failed items
+# phases can overlap (the sync is streamed) and are summed across threads
+class Profiler:
+    def __init__(self):
+        import threading
         import time
-        time.sleep(0.2)
 
-    if verbose:
-        pbar.close()
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        # name -> [total seconds, count]
+        self.phases = {}
+        # endpoint -> {"latencies": [seconds], "statuses": {status: count}, "retries": count, "bytes_sent": count, "bytes_received": count}
+        self.requests = {}
+        # reason -> number of failed items
+        self.failures = {}
 
-    if not verbose:
-        logging.info(f"Total fetched: {len(all_items)} items.")
+    # start over, e.g. for each run in daemon mode
+    def reset(self):
+        import time
+
+        with self.lock:
+            self.started = time.perf_counter()
+            self.phases = {}
+            self.requests = {}
+            self.failures = {}
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            phase = self.phases.setdefault(name, [0.0, 0])
+            phase[0] += seconds
+            phase[1] += 1
+
+    def phase(self, name):
+        import contextlib
+        import time
+
+        @contextlib.contextmanager
+        def timer():
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.add_phase(name, time.perf_counter() - start)
+        return timer()
+
+    # wrap func so each call is timed as a phase
+    def timed(self, name, func):
+        def wrapper(*args, **kwargs):
+            with self.phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    # time spent waiting for each element of iterable
+    def iterate(self, name, iterable):
+        import time
+
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                element = next(iterator)
+            except StopIteration:
+                self.add_phase(name, time.perf_counter() - start)
+                return
+            self.add_phase(name, time.perf_counter() - start)
+            yield element
+
+    # same as timed and iterate, for coroutine functions and async iterables
+    def timed_async(self, name, func):
+        async def wrapper(*args, **kwargs):
+            with self.phase(name):
+                return await func(*args, **kwargs)
+        return wrapper
+
+    async def aiterate(self, name, iterable):
+        import time
+
+        iterator = aiter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                element = await anext(iterator)
+            except StopAsyncIteration:
+                self.add_phase(name, time.perf_counter() - start)
+                return
+            self.add_phase(name, time.perf_counter() - start)
+            yield element
+
+    # median latency of the requests sent so far to the endpoints starting with prefix (e.g. "example.org/api/v2"), None if there was none
+    def median_latency(self, prefix):
+        with self.lock:
+            latencies = sorted(
+                latency
+                for endpoint, stats in self.requests.items() if endpoint.split(" ", 1)[1].startswith(prefix)
+                for latency in stats["latencies"]
+            )
+        return latencies[len(latencies) // 2] if latencies else None
+
+    # retries are the ones taken before this answer, bytes are the sizes of the request and response bodies
+    def add_request(self, method, url, seconds, status=None, retries=0, bytes_sent=0, bytes_received=0):
+        with self.lock:
+            endpoint = self.requests.setdefault(
+                endpoint_name(method, url), {"latencies": [], "statuses": {}, "retries": 0, "bytes_sent": 0, "bytes_received": 0},
+            )
+            endpoint["latencies"].append(seconds)
+            key = str(status) if status is not None else "error"
+            endpoint["statuses"][key] = endpoint["statuses"].get(key, 0) + 1
+            endpoint["retries"] += retries
+            endpoint["bytes_sent"] += bytes_sent
+            endpoint["bytes_received"] += bytes_received
+
+    def add_failure(self, reason):
+        with self.lock:
+            self.failures[reason] = self.failures.get(reason, 0) + 1
+
+    # record every request sent by a requests.Session
+    def watch_session(self, session):
+        def on_response(response, *args, **kwargs):
+            self.add_request(
+                response.request.method, response.url, response.elapsed.total_seconds(), response.status_code,
+                bytes_sent=int(response.request.headers.get("Content-Length") or 0), bytes_received=len(response.content),
+            )
+        session.hooks["response"].append(on_response)
+
+    # record every request sent by the REST client of an elabapi_python.ApiClient, with the retries of its urllib3 Retry
+    def watch_rest_client(self, rest_client):
+        import time
+        import urllib3
+
+        request = rest_client.pool_manager.request
+
+        def timed_request(method, url, *args, **kwargs):
+            start = time.perf_counter()
+            status = None
+            retries = 0
+            bytes_received = 0
+            try:
+                response = request(method, url, *args, **kwargs)
+                status = response.status
+                # the Retry that ended with this answer, its history lists the attempts before it
+                retries = len(response.retries.history) if response.retries else 0
+                bytes_received = len(response.data or b"")
+                return response
+            except urllib3.exceptions.MaxRetryError:
+                # the Retry gave up after all its retries
+                retries = RETRY_TOTAL
+                raise
+            finally:
+                body = kwargs.get("body") or b""
+                bytes_sent = len(body.encode("utf-8") if isinstance(body, str) else body)
+                self.add_request(method, url, time.perf_counter() - start, status, retries, bytes_sent, bytes_received)
+        rest_client.pool_manager.request = timed_request
+
+    def report(self):
+        import time
+
+        def percentile(values, fraction):
+            return values[min(len(values) - 1, int(fraction * len(values)))]
+
+        with self.lock:
+            phases = {
+                name: {"seconds": round(seconds, 3), "count": count}
+                for name, (seconds, count) in self.phases.items()
+            }
+            requests = {}
+            for endpoint, data in sorted(self.requests.items()):
+                latencies = sorted(data["latencies"])
+                requests[endpoint] = {
+                    "count": len(latencies),
+                    "statuses": dict(data["statuses"]),
+                    "p50": round(percentile(latencies, 0.5), 4),
+                    "p90": round(percentile(latencies, 0.9), 4),
+                    "p99": round(percentile(latencies, 0.99), 4),
+                    "max": round(latencies[-1], 4),
+                    "total_seconds": round(sum(latencies), 3),
+                    "retries": data["retries"],
+                    "bytes_sent": data["bytes_sent"],
+                    "bytes_received": data["bytes_received"],
+                }
+            failures = dict(sorted(self.failures.items()))
+        return {
+            "wall_seconds": round(time.perf_counter() - self.started, 3),
+            "phases": phases,
+            "requests": requests,
+            "failures": failures,
+        }
+
+# metrics of a sync run (see write_metrics in main.py) in the Prometheus text format, for the textfile collector of node_exporter
+# every value describes the last run, so they are all gauges
+def prometheus_text(metrics, prefix="quartzy2elabftw_run"):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    base_labels = {"target": metrics["target"]} if metrics.get("target") else {}
+    lines = []
+
+    def family(name, help_text, samples):
+        lines.append(f"# HELP {prefix}_{name} {help_text}")
+        lines.append(f"# TYPE {prefix}_{name} gauge")
+        for labels, value in samples:
+            labels = {**base_labels, **labels}
+            label_text = "{" + ",".join(f'{key}="{escape(label)}"' for key, label in labels.items()) + "}" if labels else ""
+            lines.append(f"{prefix}_{name}{label_text} {value}")
 
-    return all_items
+    requests = metrics["requests"]
+    family("timestamp_seconds", "Unix time at the end of the run.", [({}, metrics["timestamp"])])
+    family("success", "1 if every item went through, 0 if the run failed, was interrupted or had failed items.", [({}, int(metrics["status"] == "ok"))])
+    family("duration_seconds", "Duration of the run.", [({}, metrics["seconds"])])
+    family("items", "Quartzy items of the synced categories, by result.", [({"result": result}, count) for result, count in metrics["items"].items()])
+    family("items_per_second", "Quartzy items handled per second.", [({}, metrics["items_per_second"])])
+    family("orphan_failures", "Orphan items that couldn't be archived or tagged.", [({}, metrics["orphans_failed"])])
+    family("requests", "HTTP requests by endpoint and status.", [
+        ({"endpoint": endpoint, "status": status}, count) for endpoint, data in requests.items() for status, count in data["statuses"].items()
+    ])
+    family("request_retries", "Retries taken on transient errors by endpoint.", [({"endpoint": endpoint}, data["retries"]) for endpoint, data in requests.items()])
+    family("request_bytes", "Size of the request and response bodies by endpoint.", [
+        ({"endpoint": endpoint, "direction": direction}, data[f"bytes_{direction}"]) for endpoint, data in requests.items() for direction in ("sent", "received")
+    ])
+    family("item_failures", "Items that failed to sync by reason.", [({"reason": reason}, count) for reason, count in metrics["failures"].items()])
+    return "\n".join(lines) + "\n"